@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""Benchmark the tools on synthetic repositories.
+
+For every size a Packages index, a tree of debian/control files and a
+tree of Python sources are generated offline, then each phase (index
+load, snapshot compile and open, closure, version checks, output,
+control parsing, control audit, stdlib scan) is timed. Every size runs
+in its own process, so the peak RSS recorded after each phase belongs to
+that size only. --startup instead times fresh processes of the command
+line tools answering --help, --info and a small query from a snapshot,
+which is what dominates when CI runs them thousands of times. Results
+are appended to the output file as JSON lines
+tagged with the run time and git commit; --compare prints the time
+ratios between the last two runs in that file.
+"""
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from subprocess import CalledProcessError, Popen, PIPE
+
+import debindex
+import debversion
+import pkgindex
+
+output_file_name = 'bench_output.txt'
+list_name = 'bench.example.org_debian_dists_synthetic_main_binary-amd64_Packages'
+release_name = 'bench.example.org_debian_dists_synthetic_Release'
+
+# Module names for the generated Python sources: standard library ones,
+# dotted ones and ones that are in no standard library.
+source_modules = ['os', 'sys', 're', 'json', 'collections', 'os.path', 'xml.etree.ElementTree',
+                  'logging.handlers', 'subprocess', 'yaml', 'requests', 'six.moves', 'oslo_config',
+                  'stevedore', 'sqlalchemy.orm', 'urllib2', 'urllib.parse', 'ConfigParser']
+
+# Command lines timed by --startup; {package} is a package of the
+# snapshot generated for them.
+startup_commands = [['pkgver.py', '--help'], ['pkgver.py', '--info'],
+                    ['pkgver.py', '-p', '{package}', '-D', '1'],
+                    ['get_build_packages.py', '--help'], ['get_build_packages.py', '--info'],
+                    ['find_in_stdl.py', '--help']]
+startup_size = 1000
+
+
+def get_commit():
+    """Return the current git commit of the tools, or ''."""
+    try:
+        proc = Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=PIPE, stderr=PIPE,
+                     cwd=os.path.dirname(os.path.abspath(__file__)))
+        return proc.communicate()[0].decode('ascii', 'replace').strip()
+    except OSError:
+        return ''
+
+
+def package_name(number):
+    return 'pkg%05d' % number
+
+
+def random_version(generator):
+    return '%d.%d-%d' % (generator.randint(0, 3), generator.randint(0, 20), generator.randint(1, 5))
+
+
+def generate_packages(directory, count, generator):
+    """Write a Packages index of count packages and return their versions.
+
+    Every tenth package has two versions; dependencies are random and
+    include versioned relations, or-groups and virtual packages.
+    """
+    virtual_count = max(1, count // 100)
+    versions = dict((package_name(number), sorted(set(random_version(generator) for _ in range(2 if number % 10 == 0 else 1)),
+                                                  key=debversion.version_key))
+                    for number in range(count))
+
+    with open(os.path.join(directory, release_name), 'w') as release:
+        release.write('Origin: Synthetic\nSuite: synthetic\n')
+
+    index = gzip.open(os.path.join(directory, list_name + '.gz'), 'wb')
+    try:
+        for number in range(count):
+            name = package_name(number)
+            for version in versions[name]:
+                groups = []
+                for _ in range(generator.randint(0, 6)):
+                    dependency = package_name(generator.randrange(count))
+                    choice = generator.random()
+                    if choice < 0.3:
+                        groups.append('%s (>= %s)' % (dependency, generator.choice(versions[dependency])))
+                    elif choice < 0.4:
+                        groups.append('%s | %s' % (dependency, package_name(generator.randrange(count))))
+                    elif choice < 0.45:
+                        groups.append('virtual%03d' % generator.randrange(virtual_count))
+                    else:
+                        groups.append(dependency)
+
+                stanza = ['Package: ' + name, 'Version: ' + version, 'Architecture: amd64',
+                          'Source: src-' + name]
+                if groups:
+                    stanza.append('Depends: ' + ', '.join(groups))
+                if number % 50 == 0:
+                    stanza.append('Provides: virtual%03d' % (number // 50 % virtual_count))
+                stanza.append('Filename: pool/main/%s/%s_%s_amd64.deb' % (name[:4], name, version))
+                stanza.append('Description: synthetic package %d\n long description' % number)
+                index.write(('\n'.join(stanza) + '\n\n').encode('utf-8'))
+    finally:
+        index.close()
+
+    return versions
+
+
+def generate_control_files(directory, count, versions, generator):
+    """Write count // 50 source packages with a debian/control each."""
+    names = sorted(versions)
+    for number in range(max(1, count // 50)):
+        debian = os.path.join(directory, 'src%05d' % number, 'debian')
+        os.makedirs(debian)
+        build_depends = []
+        for name in generator.sample(names, min(len(names), 5)):
+            build_depends.append('%s (>= %s)' % (name, versions[name][0]) if generator.random() < 0.5 else name)
+        build_depends.append('missing-build-tool')
+
+        stanzas = ['Source: src%05d\nMaintainer: Bench <bench@example.org>\nBuild-Depends: %s' %
+                   (number, ', '.join(build_depends))]
+        for binary in range(2):
+            stanzas.append('Package: bin%05d-%d\nArchitecture: any\nDepends: %s\nDescription: binary' %
+                           (number, binary, ', '.join(generator.sample(names, min(len(names), 3)))))
+        with open(os.path.join(debian, 'control'), 'w') as control:
+            control.write('\n\n'.join(stanzas) + '\n')
+
+
+def generate_sources(directory, count, generator):
+    """Write count // 20 Python modules importing a mix of modules."""
+    for number in range(max(1, count // 20)):
+        package = os.path.join(directory, 'package%03d' % (number // 100))
+        if not os.path.isdir(package):
+            os.makedirs(package)
+        lines = []
+        for module in generator.sample(source_modules, 6):
+            if '.' in module and generator.random() < 0.5:
+                parent, name = module.rsplit('.', 1)
+                lines.append('from %s import %s' % (parent, name))
+            else:
+                lines.append('import %s' % module)
+        lines.append('\n\ndef function():\n    import os\n    return os.getcwd()\n')
+        with open(os.path.join(package, 'module%05d.py' % number), 'w') as source:
+            source.write('\n'.join(lines))
+
+
+class Phases(object):
+
+    """Times named phases and records the peak RSS after each one"""
+
+    def __init__(self, size):
+        self.size = size
+        self.records = []
+
+    def run(self, phase, function, *args):
+        """Time function(*args) as phase and return its result (None on error)."""
+        record = {'Size': self.size, 'Phase': phase}
+        started = time.time()
+        result = None
+        try:
+            result = function(*args)
+        except Exception as error:
+            record['Error'] = '%s: %s' % (type(error).__name__, error)
+        record['Time'] = time.time() - started
+        record['PeakRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.records.append(record)
+        print >> sys.stderr, '[%d] %-28s %8.3fs %8d KB%s' % (
+            self.size, phase, record['Time'], record['PeakRSS'],
+            ' (%s)' % record['Error'] if 'Error' in record else '')
+        return result
+
+
+def import_pkgver():
+    import pkgver
+    # pkgver reads its command line arguments from a module global.
+    pkgver.args = argparse.Namespace(debug=False)
+    return pkgver
+
+
+def resolve_closures(cache, roots, records):
+    """Resolve the closure of every root with a fresh TrustyPackages."""
+    pkgver = import_pkgver()
+    resolved = 0
+    for root in roots:
+        packages = pkgver.TrustyPackages(quiet=True)
+        packages.resolve_closure(cache, root)
+        records.append(pkgver.records_as_dicts(packages.pkg_dictionary))
+        resolved += len(packages.pkg_dictionary)
+    return resolved
+
+
+def check_versions(cache):
+    """Check every dependency of every package version against cache."""
+    pkgver = import_pkgver()
+    packages = pkgver.TrustyPackages(quiet=True)
+    checked = 0
+    for package in cache:
+        for version in package.versions:
+            for dependencies in version.dependencies:
+                for dependency in dependencies:
+                    packages.get_matrix_cell(cache, dependency.name, dependency.relation, dependency.version)
+                    checked += 1
+    return checked
+
+
+def write_output(records):
+    """Serialize closure records the way -o json does."""
+    return sum(len(json.dumps(closure, sort_keys=True)) for closure in records)
+
+
+def parse_controls(directory):
+    """Run the single file control parser of get_build_packages on every control file."""
+    import get_build_packages
+    for control_file in get_build_packages.find_control_files(directory):
+        packages = get_build_packages.TrustyPackages()
+        packages.prepare_control(control_file)
+        packages.build_dependencies()
+        packages.packages_build_dependencies()
+
+
+def audit_controls(directory, cache, jobs):
+    import get_build_packages
+    return get_build_packages.TrustyPackages().audit_controls(directory, cache, jobs)
+
+
+def scan_sources(directory, jobs):
+    """Run the find_in_stdl scan with its report discarded."""
+    import find_in_stdl
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        find_in_stdl.main(argparse.Namespace(directory=directory, py3=True, versions=None, output='text',
+                                             exclude=None, locations=False, cache=None,
+                                             include=None, exclude_path=None, all_dirs=False,
+                                             no_gitignore=False, follow_links=False, changed_since=None, jobs=jobs, profile=None, profile_dump=None))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def run_size(results, size, seed, work_dir, roots, jobs):
+    """Generate the data of one size, time every phase (see Phases) and
+    put the records on the results queue."""
+    phases = Phases(size)
+    try:
+        run_phases(phases, random.Random(seed), os.path.join(work_dir, str(size)), roots, jobs)
+    finally:
+        # Sent even when a phase fails, so that the parent never waits forever.
+        results.put(phases.records)
+
+
+def run_phases(phases, generator, directory, roots, jobs):
+    size = phases.size
+    indexes = os.path.join(directory, 'lists')
+    controls = os.path.join(directory, 'controls')
+    sources = os.path.join(directory, 'sources')
+    for path in [indexes, controls, sources]:
+        os.makedirs(path)
+
+    versions = phases.run('generate index', generate_packages, indexes, size, generator)
+    phases.run('generate controls', generate_control_files, controls, size, versions, generator)
+    phases.run('generate sources', generate_sources, sources, size, generator)
+
+    cache = phases.run('index load', debindex.load_cache, indexes, jobs)
+    snapshot_path = os.path.join(directory, 'pkgindex.bin')
+    phases.run('snapshot compile', pkgindex.compile_index, cache, snapshot_path)
+    snapshot = phases.run('snapshot open', pkgindex.PackageIndex, snapshot_path)
+
+    root_names = [package_name(generator.randrange(size)) for _ in range(roots)]
+    records = []
+    phases.run('closure', resolve_closures, cache, root_names, records)
+    phases.run('closure snapshot', resolve_closures, snapshot, root_names, [])
+    phases.run('version checks', check_versions, cache)
+    phases.run('output', write_output, records)
+    phases.run('prepare control', parse_controls, controls)
+    phases.run('control audit', audit_controls, controls, cache, jobs)
+    phases.run('stdlib scan', scan_sources, sources, jobs)
+
+    if snapshot is not None:
+        snapshot.close()
+
+
+def time_command(command, cwd, repeats):
+    """Run command repeats times and return its best and median wall times.
+
+    Raises CalledProcessError when a run fails.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeats):
+            started = time.time()
+            proc = Popen(command, cwd=cwd, stdout=devnull, stderr=devnull)
+            if proc.wait():
+                raise CalledProcessError(proc.returncode, ' '.join(command))
+            times.append(time.time() - started)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def run_startup(work_dir, repeats, seed):
+    """Time the startup of every startup command and return the records.
+
+    The small query reads a snapshot of startup_size packages compiled
+    into the cache directory of both repositories pkgver.py opens.
+    """
+    generator = random.Random(seed)
+    indexes = os.path.join(work_dir, 'startup-lists')
+    os.makedirs(indexes)
+    generate_packages(indexes, startup_size, generator)
+    cache = debindex.load_cache(indexes, 1)
+    for distr in ['debian', 'mos']:
+        os.makedirs(os.path.join(work_dir, 'cache', distr))
+        pkgindex.compile_index(cache, os.path.join(work_dir, 'cache', distr, 'pkgindex.bin'))
+
+    tools = os.path.dirname(os.path.abspath(__file__))
+    package = package_name(generator.randrange(startup_size))
+    records = []
+    for command in startup_commands:
+        command = [argument.format(package=package) for argument in command]
+        phase = 'start ' + ' '.join(command)
+        record = {'Size': 0, 'Phase': phase, 'Repeats': repeats}
+        started = time.time()
+        try:
+            record['Best'], record['Time'] = time_command(
+                [sys.executable, os.path.join(tools, command[0])] + command[1:], work_dir, repeats)
+        except CalledProcessError as error:
+            record['Error'] = '%s: %s' % (type(error).__name__, error)
+            record['Best'] = record['Time'] = time.time() - started
+        records.append(record)
+        print >> sys.stderr, '%-40s %8.3fs median %8.3fs best%s' % (
+            phase, record['Time'], record['Best'], ' (%s)' % record['Error'] if 'Error' in record else '')
+    return records
+
+
+def compare_runs(path):
+    """Print the phase time ratios between the last two runs in path."""
+    runs = []
+    results = {}
+    with open(path, 'r') as output:
+        for line in output:
+            record = json.loads(line)
+            if record['Run'] not in results:
+                runs.append(record['Run'])
+                results[record['Run']] = {}
+            key = (record['Size'], record['Phase'])
+            results[record['Run']][key] = results[record['Run']].get(key, 0.0) + record['Time']
+
+    if len(runs) < 2:
+        print 'Need two runs in %s to compare.' % path
+        return
+
+    old, new = results[runs[-2]], results[runs[-1]]
+    print '%-8s %-28s %10s %10s %7s' % ('Size', 'Phase', runs[-2][-8:], runs[-1][-8:], 'Ratio')
+    for key in sorted(set(old) & set(new)):
+        print '%-8d %-28s %9.3fs %9.3fs %6.2fx' % (key[0], key[1], old[key], new[key],
+                                                   new[key] / old[key] if old[key] else 0.0)
+
+
+def main(args):
+    if args.compare:
+        compare_runs(args.output)
+        return
+
+    run = time.strftime('%Y-%m-%dT%H:%M:%S')
+    common = {'Run': run, 'Commit': get_commit(), 'Python': sys.version.split()[0]}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pkg-tools-bench-')
+
+    try:
+        if args.startup:
+            with open(args.output, 'a') as output:
+                for record in run_startup(work_dir, args.startup, args.seed):
+                    record.update(common)
+                    output.write(json.dumps(record, sort_keys=True) + '\n')
+
+        for size in [] if args.startup else args.sizes:
+            # One process per size keeps the peak RSS of the sizes apart;
+            # unlike pool workers it may start pools of its own.
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_size,
+                                              args=(results, size, args.seed, work_dir, args.roots, args.jobs))
+            process.start()
+            records = results.get()
+            process.join()
+
+            with open(args.output, 'a') as output:
+                for record in records:
+                    record.update(common)
+                    output.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print 'Results of run %s appended to %s' % (run, args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pkg-tools on synthetic repositories.')
+    parser.add_argument('-s', '--sizes', nargs='+', metavar=('SIZE'), type=int, default=[1000, 10000],
+                        help='Numbers of packages to generate, e.g. 1000 10000 60000')
+    parser.add_argument('-o', '--output', metavar=('FILE'), type=str, default=output_file_name,
+                        help='File the JSON line results are appended to')
+    parser.add_argument('-c', '--compare', action='store_true',
+                        help='Compare the last two runs in the output file')
+    parser.add_argument('-r', '--roots', metavar=('ROOTS'), type=int, default=20,
+                        help='Number of packages to resolve closures for')
+    parser.add_argument('-j', '--jobs', metavar=('JOBS'), type=int,
+                        help='Worker processes for index load and control audit')
+    parser.add_argument('-S', '--seed', metavar=('SEED'), type=int, default=1,
+                        help='Random seed of the generated data')
+    parser.add_argument('-w', '--work-dir', metavar=('DIR'), type=str,
+                        help='Directory for the generated data (a temporary one by default)')
+    parser.add_argument('-t', '--startup', metavar=('REPEATS'), type=int, nargs='?', const=20,
+                        help='Time the startup of the command line tools (REPEATS runs each) '
+                             'instead of the sizes')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='Keep the generated data')
+    args = parser.parse_args()
+
+    main(args)
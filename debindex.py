@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""Pure Python backend reading Packages/Sources index files.
+
+Index files (plain, .gz, .bz2 or .xz) are streamed through a generator
+based deb822 parser that keeps only the fields the tools use. Each file
+is reduced to plain tuples, so several files can be parsed in parallel
+worker processes, and the results are merged into a Deb822Cache, which
+answers the same lookups as apt.cache.Cache: membership, item access,
+keys(), iteration, len() and is_virtual_package(). Packages expose
+versions with version, source_name, architecture, origins, uri,
+dependencies (Pre-Depends and Depends, as python-apt does) and
+provides_list.
+
+A directory of apt lists (var/lib/apt/lists) or a mirror tree of
+dists/<suite>/<component>/binary-<arch>/Packages files can be loaded.
+"""
+
+import bz2
+import gzip
+import io
+import os
+import re
+import sys
+
+import debversion
+import pkgindex
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+index_file_re = re.compile('(?P<base>.*(Packages|Sources))(\.(?P<extension>gz|bz2|xz))?$')
+apt_list_re = re.compile('^(?P<base>.+?)_dists_(?P<suite>[^_]+)_(?P<component>.+?)_'
+                         '(binary-(?P<arch>[^_]+)_Packages|source_Sources)')
+flat_list_re = re.compile('^(?P<base>.+?)_\._(Packages|Sources)')
+dists_path_re = re.compile('dists/(?P<suite>[^/]+)/(?P<component>.+?)/'
+                           '(binary-(?P<arch>[^/]+)/Packages|source/Sources)')
+relation_re = re.compile('^\s*(?P<name>[A-Za-z0-9][A-Za-z0-9+.-]*)(:[A-Za-z0-9-]+)?\s*'
+                         '(\(\s*(?P<relation><<|<=|>=|>>|=|<|>)\s*(?P<version>[^\s)]+)\s*\))?')
+release_field_re = re.compile('^(?P<field>Origin|Suite):\s*(?P<value>\S+)')
+
+# Relations in python-apt notation, where '<' and '>' are strict; the
+# deprecated control-file forms '<' and '>' mean '<=' and '>='.
+relations = {'<<': '<', '>>': '>', '<': '<=', '>': '>=', '<=': '<=', '>=': '>=', '=': '='}
+
+packages_fields = frozenset(['Package', 'Version', 'Source', 'Architecture', 'Pre-Depends',
+                             'Depends', 'Provides', 'Filename'])
+sources_fields = frozenset(['Package', 'Version', 'Binary', 'Build-Depends',
+                            'Build-Depends-Indep', 'Directory'])
+# Preferred file of the same index when several compressions are present.
+extension_order = [None, 'gz', 'xz', 'bz2']
+
+
+def open_index(path):
+    """Open a possibly compressed index file for reading text lines."""
+    if path.endswith('.gz'):
+        stream = gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        stream = bz2.BZ2File(path, 'rb')
+    elif path.endswith('.xz'):
+        if lzma is None:
+            raise ValueError('%s: reading .xz files needs the lzma module' % path)
+        stream = lzma.open(path, 'rb')
+    else:
+        stream = open(path, 'rb')
+
+    if sys.version_info[0] >= 3:
+        return io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    return stream
+
+
+def iter_stanzas(lines, fields=None):
+    """Yield every deb822 stanza of lines as a field -> value dict.
+
+    Continuation lines are joined with newlines; fields not in fields
+    (when given) are skipped without being stored.
+    """
+    stanza = {}
+    name = None
+    for line in lines:
+        if line[:1] in (' ', '\t'):
+            if name is not None:
+                stanza[name] += '\n' + line.strip()
+            continue
+
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            if stanza:
+                yield stanza
+                stanza = {}
+            name = None
+            continue
+        if line.startswith('#'):
+            continue
+
+        key, separator, value = line.partition(':')
+        if not separator or (fields is not None and key not in fields):
+            name = None
+            continue
+        stanza[key] = value.strip()
+        name = key
+
+    if stanza:
+        yield stanza
+
+
+def parse_relations(value):
+    """Parse a relation field into or-groups of (name, relation, version)."""
+    groups = []
+    for group in value.split(','):
+        alternatives = []
+        for alternative in group.split('|'):
+            match = relation_re.match(alternative)
+            if match:
+                relation = match.group('relation')
+                alternatives.append((match.group('name'), relations[relation] if relation else '',
+                                     match.group('version') or ''))
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+
+def get_release_origin(path, base, suite):
+    """Return the Origin field of the Release file next to an apt list."""
+    directory = os.path.dirname(path)
+    for name in ['InRelease', 'Release']:
+        release_path = os.path.join(directory, '%s_dists_%s_%s' % (base, suite, name))
+        if os.path.exists(release_path):
+            with open(release_path, 'r') as release:
+                for line in release:
+                    match = release_field_re.match(line)
+                    if match and match.group('field') == 'Origin':
+                        return match.group('value')
+    return ''
+
+
+def get_file_origin(path):
+    """Return ((component, archive, site, origin, archive uri), base uri) of an index file.
+
+    The archive uri is the base uri without its trailing slash.
+    """
+    match = apt_list_re.match(os.path.basename(path))
+    if match:
+        base = match.group('base')
+        uri = 'http://' + base.replace('_', '/')
+        origin = (match.group('component'), match.group('suite'), base.split('_', 1)[0],
+                  get_release_origin(path, base, match.group('suite')), uri)
+        return origin, uri + '/'
+
+    # Flat repositories ("deb URI ./") have neither suite nor component.
+    match = flat_list_re.match(os.path.basename(path))
+    if match:
+        base = match.group('base')
+        uri = 'http://' + base.replace('_', '/')
+        return ('', '', base.split('_', 1)[0], '', uri), uri + '/'
+
+    # A mirror tree is shown the way apt shows a file: archive.
+    path = os.path.abspath(path).replace(os.sep, '/')
+    match = dists_path_re.search(path)
+    if match:
+        uri = 'file:' + path[:match.start()].rstrip('/')
+        return (match.group('component'), match.group('suite'), '', '', uri), uri + '/'
+
+    return ('', '', '', '', ''), ''
+
+
+def parse_index_file(path):
+    """Parse one Packages or Sources file into picklable tuples.
+
+    Returns (kind, origin, base uri, records) where kind is 'Packages'
+    or 'Sources'.
+    """
+    origin, base_uri = get_file_origin(path)
+    kind = 'Sources' if index_file_re.match(path).group('base').endswith('Sources') else 'Packages'
+    records = []
+
+    index = open_index(path)
+    try:
+        if kind == 'Packages':
+            for stanza in iter_stanzas(index, packages_fields):
+                if 'Package' not in stanza or 'Version' not in stanza:
+                    continue
+                dependencies = parse_relations(stanza.get('Pre-Depends', '')) + \
+                    parse_relations(stanza.get('Depends', ''))
+                provides = [(group[0][0], group[0][2] if group[0][1] == '=' else '')
+                            for group in parse_relations(stanza.get('Provides', ''))]
+                source_name = stanza.get('Source', '').split(' ', 1)[0] or stanza['Package']
+                records.append((stanza['Package'], stanza['Version'], source_name,
+                                stanza.get('Architecture', ''), dependencies, provides,
+                                stanza.get('Filename', '')))
+        else:
+            for stanza in iter_stanzas(index, sources_fields):
+                if 'Package' not in stanza or 'Version' not in stanza:
+                    continue
+                binaries = [name.strip() for name in stanza.get('Binary', '').split(',') if name.strip()]
+                records.append((stanza['Package'], stanza['Version'], binaries,
+                                parse_relations(stanza.get('Build-Depends', '')),
+                                parse_relations(stanza.get('Build-Depends-Indep', '')),
+                                stanza.get('Directory', '')))
+    finally:
+        index.close()
+
+    return kind, origin, base_uri, records
+
+
+def find_index_files(directory):
+    """Return the Packages/Sources files under directory, one compression each."""
+    found = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            match = index_file_re.match(name)
+            if not match:
+                continue
+            base = os.path.join(root, match.group('base'))
+            extension = match.group('extension')
+            if base not in found or extension_order.index(extension) < extension_order.index(found[base][0]):
+                found[base] = (extension, os.path.join(root, name))
+
+    return sorted(path for extension, path in found.values())
+
+
+class Deb822Version(object):
+
+    """Package version read from a Packages stanza"""
+    __slots__ = ('version', 'source_name', 'architecture', 'uri', 'provides_list',
+                 '_origins', '_dependencies')
+
+    def __init__(self, version, source_name, architecture, dependencies, provides, uri):
+        self.version = version
+        self.source_name = source_name
+        self.architecture = architecture
+        self.provides_list = provides
+        self.uri = uri
+        self._origins = []
+        self._dependencies = dependencies
+
+    @property
+    def origins(self):
+        return [pkgindex.IndexOrigin(*origin) for origin in self._origins]
+
+    @property
+    def dependencies(self):
+        return [[pkgindex.IndexDependency(*dependency) for dependency in group]
+                for group in self._dependencies]
+
+
+class Deb822Package(object):
+
+    """Binary package with its versions, newest first"""
+    __slots__ = ('name', 'versions')
+
+    def __init__(self, name):
+        self.name = name
+        self.versions = []
+
+
+class Deb822Source(object):
+
+    """Source package read from a Sources stanza"""
+    __slots__ = ('name', 'version', 'binaries', 'build_depends', 'build_depends_indep',
+                 'directory', 'origin')
+
+    def __init__(self, name, version, binaries, build_depends, build_depends_indep, directory, origin):
+        self.name = name
+        self.version = version
+        self.binaries = binaries
+        self.build_depends = build_depends
+        self.build_depends_indep = build_depends_indep
+        self.directory = directory
+        self.origin = origin
+
+
+class Deb822Cache(object):
+
+    """apt.cache.Cache look-alike over parsed index files"""
+
+    def __init__(self):
+        self._packages = {}
+        self.sources = {}
+
+    def add_index(self, kind, origin, base_uri, records):
+        """Merge the result of parse_index_file into the cache."""
+        if kind == 'Sources':
+            for name, version, binaries, build_depends, build_depends_indep, directory in records:
+                self.sources.setdefault(name, []).append(
+                    Deb822Source(name, version, binaries, build_depends, build_depends_indep, directory, origin))
+            return
+
+        for name, version, source_name, architecture, dependencies, provides, filename in records:
+            package = self._packages.get(name)
+            if package is None:
+                package = self._packages[name] = Deb822Package(name)
+
+            # The same version in several archives is one version with
+            # several origins, as in apt.
+            for known in package.versions:
+                if known.version == version and known.architecture == architecture:
+                    break
+            else:
+                known = Deb822Version(version, source_name, architecture, dependencies, provides,
+                                      base_uri + filename if filename else '')
+                package.versions.append(known)
+            known._origins.append(origin)
+
+    def sort_versions(self):
+        for package in self._packages.values():
+            if len(package.versions) > 1:
+                package.versions.sort(key=lambda version: debversion.version_key(version.version), reverse=True)
+
+    def __contains__(self, name):
+        return name in self._packages
+
+    def __getitem__(self, name):
+        return self._packages[name]
+
+    def __len__(self):
+        return len(self._packages)
+
+    def __iter__(self):
+        return iter(self._packages.values())
+
+    def keys(self):
+        return list(self._packages.keys())
+
+    def is_virtual_package(self, name):
+        return name not in self and bool(pkgindex.get_dependency_index(self).providers(name))
+
+    def close(self):
+        pass
+
+
+def load_cache(directory, jobs=None):
+    """Parse every index file under directory into a Deb822Cache."""
+    return load_index_files(find_index_files(directory), jobs)
+
+
+def load_index_files(paths, jobs=None):
+    """Parse the index files in paths into a Deb822Cache.
+
+    Files are parsed in a pool of jobs worker processes (one per CPU by
+    default); pass jobs=1 to parse them in this process.
+    """
+    import multiprocessing
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs > 1 and len(paths) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(paths)))
+        try:
+            results = pool.map(parse_index_file, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [parse_index_file(path) for path in paths]
+
+    cache = Deb822Cache()
+    for result in results:
+        cache.add_index(*result)
+    cache.sort_versions()
+
+    return cache
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""Memoized Debian version comparison.
+
+version_compare() gives the same results as apt_pkg.version_compare()
+and remembers recent results in a bounded LRU memo. It calls apt_pkg
+when python-apt is available, importing it on the first comparison, and
+a port of apt's algorithm otherwise.
+
+version_key() turns a version string into a key that sorts like
+version_compare(), so version lists can be sorted once and searched with
+bisect: VersionList.satisfying() returns every version matching a
+(relation, version) constraint in O(log n).
+"""
+
+import bisect
+import threading
+from collections import OrderedDict
+
+memo_size = 65536
+
+# Relations as returned by python-apt ('<' and '>' are strict there) and
+# as written in control files.
+lower_relations = ['<', '<<']
+lower_equal_relations = ['<=']
+greater_relations = ['>', '>>']
+greater_equal_relations = ['>=']
+equal_relations = ['=', '==']
+not_equal_relations = ['!=']
+
+
+class LRUCache(object):
+
+    """Bounded mapping that drops the least recently used entries
+
+    It may be shared between threads (pkgserver.py answers queries in
+    several); get() and set() hold a lock.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def order(char):
+    """Sort weight of a non-digit version character, as in apt."""
+    if char.isdigit():
+        return 0
+    elif char.isalpha():
+        return ord(char)
+    elif char == '~':
+        return -1
+    elif char:
+        return ord(char) + 256
+    else:
+        return 0
+
+
+def compare_fragment(left, right):
+    """Compare two version fragments exactly like apt's CmpFragment."""
+    lhs = rhs = 0
+    left_end = len(left)
+    right_end = len(right)
+
+    def at(string, position):
+        return string[position] if position < len(string) else ''
+
+    while lhs != left_end and rhs != right_end:
+        first_diff = 0
+
+        while lhs != left_end and rhs != right_end and \
+                (not left[lhs].isdigit() or not right[rhs].isdigit()):
+            difference = order(left[lhs]) - order(right[rhs])
+            if difference:
+                return difference
+            lhs += 1
+            rhs += 1
+
+        while at(left, lhs) == '0':
+            lhs += 1
+        while at(right, rhs) == '0':
+            rhs += 1
+        while at(left, lhs).isdigit() and at(right, rhs).isdigit():
+            if not first_diff:
+                first_diff = ord(left[lhs]) - ord(right[rhs])
+            lhs += 1
+            rhs += 1
+
+        if at(left, lhs).isdigit():
+            return 1
+        if at(right, rhs).isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+
+    if lhs == left_end and rhs == right_end:
+        return 0
+    if lhs == left_end:
+        return 1 if right[rhs] == '~' else -1
+    if rhs == right_end:
+        return -1 if left[lhs] == '~' else 1
+    return 1
+
+
+def split_version(version):
+    """Split version into (epoch, upstream, revision) as apt does."""
+    epoch, colon, rest = version.partition(':')
+    if not colon:
+        epoch, rest = '', version
+    else:
+        # A zero epoch is the same as no epoch.
+        epoch = epoch.lstrip('0')
+
+    upstream, dash, revision = rest.rpartition('-')
+    if not dash:
+        # No revision compares like a "-0" one.
+        upstream, revision = rest, '0'
+
+    return epoch, upstream, revision
+
+
+def compare_versions(left, right):
+    """Pure Python equivalent of apt_pkg.version_compare."""
+    for left_part, right_part in zip(split_version(left), split_version(right)):
+        result = compare_fragment(left_part, right_part)
+        if result:
+            return result
+    return 0
+
+
+# Compares above the end of any fragment and below every character but '~'.
+fragment_end = ((0,), -1)
+
+
+def fragment_key(fragment):
+    """Sort key of a version fragment consistent with compare_fragment."""
+    key = []
+    position = 0
+    length = len(fragment)
+    while position < length:
+        start = position
+        while position < length and not fragment[position].isdigit():
+            position += 1
+        letters = tuple(order(char) for char in fragment[start:position]) + (0,)
+        start = position
+        while position < length and fragment[position].isdigit():
+            position += 1
+        key.append((letters, int(fragment[start:position] or 0)))
+    key.append(fragment_end)
+    return tuple(key)
+
+
+def get_backend():
+    """Return apt_pkg.version_compare, or compare_versions without python-apt."""
+    try:
+        import apt_pkg
+    except ImportError:
+        return compare_versions
+    apt_pkg.init_system()
+    return apt_pkg.version_compare
+
+
+class VersionComparator(object):
+
+    """Memoized version comparison and sort keys with usage counters"""
+
+    def __init__(self, size=memo_size):
+        self.compared = LRUCache(size)
+        self.keys = LRUCache(size)
+        self.bulk_calls = 0
+        self.backend = None
+
+    def compare(self, left, right):
+        """Memoized version_compare(left, right)."""
+        try:
+            return self.compared.get((left, right))
+        except KeyError:
+            if self.backend is None:
+                self.backend = get_backend()
+            result = self.backend(left, right)
+            self.compared.set((left, right), result)
+            return result
+
+    def key(self, version):
+        """Memoized sort key of version."""
+        try:
+            return self.keys.get(version)
+        except KeyError:
+            key = tuple(fragment_key(part) for part in split_version(version))
+            self.keys.set(version, key)
+            return key
+
+    def stats(self):
+        return {'Compare calls': self.compared.hits + self.compared.misses,
+                'Compare hits': self.compared.hits,
+                'Key calls': self.keys.hits + self.keys.misses,
+                'Key hits': self.keys.hits,
+                'Bulk calls': self.bulk_calls}
+
+    def format_stats(self):
+        stats = self.stats()
+        compare_rate = 100.0 * stats['Compare hits'] / max(1, stats['Compare calls'])
+        key_rate = 100.0 * stats['Key hits'] / max(1, stats['Key calls'])
+        return ('Version compare: %d calls, %.1f%% memo hits; sort keys: %d calls, '
+                '%.1f%% memo hits; %d bulk constraint checks' %
+                (stats['Compare calls'], compare_rate, stats['Key calls'], key_rate,
+                 stats['Bulk calls']))
+
+
+comparator = VersionComparator()
+
+
+def version_compare(left, right):
+    return comparator.compare(left, right)
+
+
+def version_key(version):
+    return comparator.key(version)
+
+
+def satisfies(version, relation, required):
+    """Whether version satisfies the (relation, required) constraint."""
+    return bool(VersionList([version]).satisfying(relation, required))
+
+
+class VersionList(object):
+
+    """Versions sorted once by version_key and searched with bisect"""
+
+    def __init__(self, versions, key=None):
+        """versions are strings, or objects whose key(object) is the version string."""
+        self.key = key or (lambda version: version)
+        decorated = sorted((version_key(self.key(version)), number, version)
+                           for number, version in enumerate(versions))
+        self.keys = [item[0] for item in decorated]
+        self.versions = [item[2] for item in decorated]
+
+    def __len__(self):
+        return len(self.versions)
+
+    def newest(self):
+        return self.versions[-1] if self.versions else None
+
+    def satisfying(self, relation, version):
+        """Return the versions satisfying (relation, version), oldest first."""
+        comparator.bulk_calls += 1
+        if not relation:
+            return list(self.versions)
+
+        key = version_key(version)
+        if relation in greater_equal_relations:
+            return self.versions[bisect.bisect_left(self.keys, key):]
+        if relation in greater_relations:
+            return self.versions[bisect.bisect_right(self.keys, key):]
+        if relation in lower_equal_relations:
+            return self.versions[:bisect.bisect_right(self.keys, key)]
+        if relation in lower_relations:
+            return self.versions[:bisect.bisect_left(self.keys, key)]
+        if relation in equal_relations:
+            return self.versions[bisect.bisect_left(self.keys, key):bisect.bisect_right(self.keys, key)]
+        if relation in not_equal_relations:
+            return self.versions[:bisect.bisect_left(self.keys, key)] + \
+                self.versions[bisect.bisect_right(self.keys, key):]
+        raise ValueError('Unknown version relation: %s' % relation)
@@ -1,96 +1,464 @@
 #!/usr/bin/env python
 
 import argparse
+import ast
+import gzip
+import hashlib
+import instrument
+import io
+import json
 import logging
 import os
 import sys
-import re
+import tempfile
+import tokenize
+import treewalk
 
+from collections import OrderedDict
 from os.path import join
-from stdlib_list import stdlib_list
+from subprocess import Popen, PIPE
 
 py2_version = "2.7"
 py3_version = "3.4"
 
-py2_libraries = stdlib_list(py2_version)
-py3_libraries = stdlib_list(py3_version)
+# Classification of a module in one Python version.
+stdlib_status = 'stdlib'
+submodule_status = 'missing-submodule'
+third_party_status = 'third-party'
+# Tokens that never start or end an import statement.
+skipped_tokens = frozenset([tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT,
+                            getattr(tokenize, 'ENCODING', tokenize.NL)])
+# Files handed to a worker process at a time.
+scan_chunk_size = 32
+# Scan cache file written into the scanned directory by default.
+cache_file_name = '.find_in_stdl.cache'
 
-import_line_re = re.compile('^(\s+)?import\s|^(\s+)?from\s')
-import_from_re = re.compile('^from\s+(?P<module_name>[A-z0-9_.]+)\s+import\s+(?P<imported_modules_names>[A-z0-9_., ]+)')
-import_re = re.compile('^import\s+(?P<modules_names>[A-z0-9_., ]+)')
-main_module_re = re.compile('^(?P<main_module>[A-z0-9_]+)\.')
+# Standard library module sets by version, loaded on first use.
+libraries = {}
 
-modules = []
 
+def get_libraries(version):
+    if version not in libraries:
+        from stdlib_list import stdlib_list
+        libraries[version] = frozenset(stdlib_list(version))
+    return libraries[version]
 
-def module_in_the_line(line, module_list):
-    for module in module_list:
-        if line.startswith('import ' + module) or line.startswith('from ' + module):
+
+class StdlibIndex(object):
+
+    """Standard library membership of module names across Python versions
+
+    Every standard library module of every version, and every dotted
+    prefix of one, maps to a bitmask of the versions having it, so a
+    module is classified with two lookups however many versions are
+    checked.
+    """
+
+    def __init__(self, versions):
+        self.versions = list(versions)
+        self.modules = {}
+        self.prefixes = {}
+        for bit, version in enumerate(self.versions):
+            flag = 1 << bit
+            for name in get_libraries(version):
+                self.modules[name] = self.modules.get(name, 0) | flag
+                parts = name.split('.')
+                for end in range(1, len(parts) + 1):
+                    prefix = '.'.join(parts[:end])
+                    self.prefixes[prefix] = self.prefixes.get(prefix, 0) | flag
+
+    def classify(self, module):
+        """Return the main module of module and its status in every version.
+
+        A module is stdlib where it is listed, missing-submodule where only
+        its main (top-level) module is, and third-party elsewhere.
+        """
+        main_module = module.split('.', 1)[0] if '.' in module else ''
+        module_flags = self.modules.get(module, 0)
+        main_flags = self.prefixes.get(main_module, 0) if main_module else 0
+        statuses = []
+        for bit in range(len(self.versions)):
+            flag = 1 << bit
+            if module_flags & flag:
+                statuses.append(stdlib_status)
+            elif main_flags & flag:
+                statuses.append(submodule_status)
+            else:
+                statuses.append(third_party_status)
+        return main_module, statuses
+
+
+def format_matrix(versions, rows):
+    """Return (module, statuses) rows as a module x version text table."""
+    table = [['Module'] + list(versions)]
+    for module, statuses in rows:
+        table.append([module] + statuses)
+
+    widths = [max(len(line[column]) for line in table) for column in range(len(table[0]))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+                     for line in table)
+
+
+def is_excluded(module, exclude):
+    for prefix in exclude:
+        if module.startswith(prefix):
             return True
 
     return False
 
 
-def main(args):
-    for root, dirs, files in os.walk(args.directory):
-        files_in_cur_dir = [join(root,name) for name in files if name.endswith('.py')]
-        for file in files_in_cur_dir:
-            with open(file) as open_file:
-                for line in open_file:
-                    if import_line_re.match(line):
-                        line = re.sub('^\s+','',line)
-                        line = re.sub('\s{2,}',' ',line)
-
-                        if args.exclude and module_in_the_line(line, args.exclude):
-                            continue
-
-                        if line.startswith('from'):
-                            match = import_from_re.match(line)
-                            if match:
-                                for module in match.group('imported_modules_names').split(','):
-                                    if module:
-                                        if match.group('module_name').startswith('.'):
-                                            continue
-
-                                        formated_module = match.group('module_name') + '.' + re.sub('(^\s|\s$|\sas\s[A-z0-9._]+)','',module)
-
-                                        if formated_module not in modules:
-                                            modules.append(formated_module)
-                        else:
-                            match = import_re.match(line)
-
-                            if match:
-                                for module in match.group('modules_names').split(','):
-                                    if module:
-                                        if module.startswith('.'):
-                                            continue
-
-                                        formated_module = re.sub('(^\s|\s$|\sas\s[A-z0-9._]+)','',module)
-
-                                        if formated_module not in modules:
-                                            modules.append(formated_module)
-
-    
-    for module in modules:
-        main_module = ''
-        match = main_module_re.match(module)
-
-        if match:
-            main_module = match.group('main_module')
-
-        if module not in py2_libraries:
-            if main_module and main_module in py2_libraries:
-                print('Main "%s" is in STD-LIB-%s but %s is not. Please check documentation.' % (main_module, py2_version, module))
-            else:
-                print('Module "%s" is not in STD-LIB-%s' % (module, py2_version))
+def find_changed_files(directory, ref, walker):
+    """Return the files under directory changed since the git ref ref
+    that walker would yield.
+
+    Committed, staged, unstaged and untracked changes all count; deleted
+    files are left out.
+    """
+    def git(*arguments):
+        proc = Popen(('git',) + arguments, stdout=PIPE, stderr=PIPE, cwd=directory)
+        output, error = proc.communicate()
+        if proc.returncode:
+            sys.stderr.write('git %s failed: %s' % (' '.join(arguments), error.decode('utf-8', 'replace')))
+            sys.exit(2)
+        return output.decode('utf-8')
 
-        if args.py3:
-            if module not in py3_libraries:
-                if main_module and main_module in py3_libraries:
-                    print('Main "%s" is in STD-LIB-%s but %s is not. Please check documentation.' % (main_module, py3_version, module))
+    top_level = git('rev-parse', '--show-toplevel').strip()
+    names = git('diff', '--name-only', '-z', ref, '--').split('\0')
+    names += git('ls-files', '--others', '--exclude-standard', '-z').split('\0')
+
+    root = os.path.realpath(directory)
+    paths = set()
+    for name in names:
+        path = os.path.join(top_level, name)
+        if not name or not os.path.isfile(path):
+            continue
+        relative_path = os.path.relpath(os.path.realpath(path), root)
+        if not relative_path.startswith(os.pardir + os.sep) and walker.accepts(relative_path):
+            paths.add(join(directory, relative_path))
+    return sorted(paths)
+
+
+def imports_from_ast(tree):
+    """Return the (module, line) pairs of the absolute imports in tree."""
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append((alias.name, node.lineno))
+        elif isinstance(node, ast.ImportFrom):
+            if node.level or not node.module:
+                continue
+            for alias in node.names:
+                if alias.name == '*':
+                    imports.append((node.module, node.lineno))
                 else:
-                    print('Module "%s" is not in STD-LIB-%s' % (module, py3_version))
+                    imports.append((node.module + '.' + alias.name, node.lineno))
+
+    # ast.walk is breadth first; report the imports in file order.
+    imports.sort(key=lambda item: item[1])
+    return imports
+
+
+def split_statements(tokens):
+    """Group tokens into (value, line) lists, one per logical statement."""
+    statement = []
+    for token in tokens:
+        token_type, value = token[0], token[1]
+        if token_type in (tokenize.NEWLINE, tokenize.ENDMARKER) or (token_type == tokenize.OP and value == ';'):
+            if statement:
+                yield statement
+            statement = []
+        elif token_type not in skipped_tokens:
+            statement.append((value, token[2][0]))
+
+
+def parse_import_statement(statement):
+    """Return the (module, line) pairs of one tokenized import statement."""
+    words = [value for value, line in statement if value not in ('(', ')')]
+    line = statement[0][1]
+    imports = []
+    if words[0] == 'import':
+        for name in ' '.join(words[1:]).split(','):
+            name = name.split(' as ')[0].replace(' ', '')
+            if name:
+                imports.append((name, line))
+    elif 'import' in words:
+        position = words.index('import')
+        module = ''.join(words[1:position])
+        if not module or module.startswith('.'):
+            return []
+        for name in ' '.join(words[position + 1:]).split(','):
+            name = name.split(' as ')[0].replace(' ', '')
+            if name == '*':
+                imports.append((module, line))
+            elif name:
+                imports.append((module + '.' + name, line))
+    return imports
+
+
+def imports_from_tokens(source):
+    """Return the (module, line) pairs of the imports found by tokenize.
+
+    Used for files ast cannot parse, such as Python 3 only files scanned
+    by Python 2; multi-line and parenthesised imports are still found.
+    """
+    readline = io.BytesIO(source).readline
+    if sys.version_info[0] >= 3:
+        tokens = tokenize.tokenize(readline)
+    else:
+        tokens = tokenize.generate_tokens(readline)
+
+    imports = []
+    for statement in split_statements(tokens):
+        if statement[0][0] in ('import', 'from'):
+            imports.extend(parse_import_statement(statement))
+    return imports
+
+
+def scan_file(path, known_digest=None):
+    """Return (path, imports, error, tokenized, digest) for one source file.
+
+    imports is the list of (module, line) pairs of its absolute imports;
+    tokenized tells whether ast failed and tokenize was used instead, and
+    digest is the hash of the content. When that is known_digest the file
+    is not parsed again and imports is None.
+    """
+    try:
+        with open(path, 'rb') as source_file:
+            source = source_file.read()
+    except (IOError, OSError) as error:
+        return path, [], str(error), False, None
+
+    digest = hashlib.sha1(source).hexdigest()
+    if digest == known_digest:
+        return path, None, None, False, digest
+
+    try:
+        return path, imports_from_ast(ast.parse(source, path)), None, False, digest
+    except (SyntaxError, TypeError, ValueError):
+        pass
+
+    try:
+        return path, imports_from_tokens(source), None, True, digest
+    except (tokenize.TokenError, SyntaxError, UnicodeDecodeError) as error:
+        return path, [], str(error), True, digest
+
+
+def scan_task(task):
+    return scan_file(*task)
+
+
+def scan_files(tasks, jobs=None):
+    """Yield the scan_file result of every (path, known digest) task, in order.
+
+    Files are scanned in a pool of jobs worker processes (one per CPU by
+    default); pass jobs=1 to scan them in this process.
+    """
+    import multiprocessing
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs <= 1:
+        for task in tasks:
+            yield scan_task(task)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(scan_task, tasks, scan_chunk_size):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ScanCache(object):
+
+    """Imports of the scanned files kept between runs in a gzipped JSON file
+
+    Entries are keyed by the path relative to root and hold the
+    modification time, size and content hash of the file with its
+    imports and whether they were found by tokenize. Files whose time
+    and size match their entry are not read at all; files whose content
+    still hashes the same are not parsed again.
+    """
+    format = 2
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.entries = {}
+        self.changed = False
+        try:
+            with gzip.open(path, 'rb') as cache_file:
+                data = json.loads(cache_file.read().decode('utf-8'))
+        except (IOError, OSError, EOFError, ValueError):
+            # Missing or unreadable; it is rebuilt by this run.
+            return
+        if data.get('Format') == self.format:
+            self.entries = data['Files']
+
+    def scan(self, paths, jobs=None, prune=True):
+        """Yield the scan_file result of every path, in order.
+
+        Only the files missing from the cache or changed since are handed
+        to scan_files. With prune, entries of files not in paths are
+        dropped.
+        """
+        files = []
+        tasks = []
+        for path in paths:
+            key = os.path.relpath(path, self.root)
+            entry = self.entries.get(key)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if entry and stat and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+                files.append((path, key, stat, True))
+            else:
+                files.append((path, key, stat, False))
+                tasks.append((path, entry[2] if entry else None))
+
+        scanned = {}
+        if tasks:
+            scanned = dict((result[0], result) for result in scan_files(tasks, jobs))
+
+        for path, key, stat, cached in files:
+            if cached:
+                instrument.count('cache hits')
+                entry = self.entries[key]
+                yield path, entry[3], None, entry[4], entry[2]
+                continue
+
+            path, imports, error, tokenized, digest = scanned[path]
+            self.changed = True
+            if error or stat is None:
+                self.entries.pop(key, None)
+            else:
+                if imports is None:
+                    instrument.count('cache rehashed')
+                    imports, tokenized = self.entries[key][3:5]
+                self.entries[key] = [stat.st_mtime, stat.st_size, digest, imports, tokenized]
+            yield path, imports, error, tokenized, digest
+
+        if prune:
+            keys = set(file[1] for file in files)
+            for key in list(self.entries):
+                if key not in keys:
+                    del self.entries[key]
+                    self.changed = True
+
+    def save(self):
+        """Write the cache if this run changed it."""
+        if not self.changed:
+            return
+
+        data = json.dumps({'Format': self.format, 'Files': self.entries}, separators=(',', ':'))
+        handle, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(handle, 'wb') as raw_file:
+                cache_file = gzip.GzipFile(fileobj=raw_file, mode='wb')
+                try:
+                    cache_file.write(data.encode('utf-8'))
+                finally:
+                    cache_file.close()
+            os.rename(temporary_path, self.path)
+        except (IOError, OSError):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        self.changed = False
+
+
+def collect_imports(results, exclude=None):
+    """Return module name -> 'file:line' of every import of it, in the order found.
+
+    results are scan_file results; the unreadable files are reported to
+    stderr.
+    """
+    modules = OrderedDict()
+    for path, imports, error, tokenized, digest in results:
+        instrument.count('files scanned')
+        if error:
+            instrument.count('unreadable files')
+            sys.stderr.write('Could not scan %s: %s\n' % (path, error))
+            continue
+        if tokenized:
+            instrument.count('files tokenized')
+        instrument.count('imports found', len(imports))
+
+        for module, line in imports:
+            if exclude and is_excluded(module, exclude):
+                continue
+
+            location = '%s:%d' % (path, line)
+            if module in modules:
+                modules[module].append(location)
+            else:
+                modules[module] = [location]
+
+    return modules
+
+
+def print_report(output, versions, rows, modules, locations=False):
+    """Print the (module, main module, statuses) rows in the output format."""
+    if output == 'json':
+        print(json.dumps({'Versions': versions,
+                          'Modules': [{'Module': module, 'Main': main_module,
+                                       'Statuses': dict(zip(versions, statuses)),
+                                       'Locations': modules[module]}
+                                      for module, main_module, statuses in rows]}, sort_keys=True))
+    elif output == 'matrix':
+        print(format_matrix(versions, [(module, statuses) for module, main_module, statuses in rows]))
+    else:
+        for module, main_module, statuses in rows:
+            for version, status in zip(versions, statuses):
+                if status == submodule_status:
+                    print('Main "%s" is in STD-LIB-%s but %s is not. Please check documentation.' % (main_module, version, module))
+                elif status == third_party_status:
+                    print('Module "%s" is not in STD-LIB-%s' % (module, version))
+
+            if locations and set(statuses) != set([stdlib_status]):
+                for location in modules[module]:
+                    print('    %s' % location)
+
+
+def main(args):
+    instrument.configure(args.profile, args.profile_dump)
+    walker = treewalk.TreeWalker(args.include, args.exclude_path, use_default_excludes=not args.all_dirs,
+                                 use_gitignore=not args.no_gitignore, follow_links=args.follow_links)
+    if args.changed_since:
+        paths = find_changed_files(args.directory, args.changed_since, walker)
+    else:
+        # Streamed: files are scanned while the walk goes on.
+        paths = walker.walk(args.directory)
+
+    cache = None
+    if args.cache is not None:
+        cache = ScanCache(args.cache or join(args.directory, cache_file_name), args.directory)
+        results = cache.scan(paths, args.jobs, prune=not args.changed_since)
+    else:
+        results = scan_files(((path, None) for path in paths), args.jobs)
+
+    with instrument.phase('scan'):
+        modules = collect_imports(results, args.exclude)
+
+    instrument.count('directories walked', walker.directories)
+    instrument.count('directories pruned', walker.pruned)
+    if cache is not None:
+        with instrument.phase('cache save'):
+            cache.save()
+
+    versions = args.versions or [py2_version] + ([py3_version] if args.py3 else [])
+    with instrument.phase('classify'):
+        index = StdlibIndex(versions)
+        rows = [(module,) + index.classify(module) for module in modules]
+
+    with instrument.phase('output'):
+        print_report(args.output, versions, rows, modules, args.locations)
 
+    instrument.report()
 
 
 if __name__ == '__main__':
@@ -98,8 +466,36 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--directory', metavar=('DIR'), type=str,
                         help='Directory', default='.')
     parser.add_argument('-p', '--py3', help='Whether to add py3 support', action='store_true')
+    parser.add_argument('-V', '--versions', nargs='+', metavar=('VERSION'), type=str,
+                        help='Python versions to check against (default: %s, and %s with --py3)' % (py2_version, py3_version))
+    parser.add_argument('-o', '--output', choices=['text', 'matrix', 'json'], default='text',
+                        help='Report non-standard modules as text, or every module as a '
+                             'module x version matrix or JSON')
+    parser.add_argument('-i', '--include', nargs='+', metavar=('GLOB'), type=str,
+                        help='Files to scan (default: %s)' % ' '.join(treewalk.default_includes))
+    parser.add_argument('-x', '--exclude-path', nargs='+', metavar=('GLOB'), type=str,
+                        help='Files and directories not to scan, e.g. vendor \'tests/*\'')
+    parser.add_argument('-a', '--all-dirs', action='store_true',
+                        help='Also walk VCS, virtualenv, tox, build and node_modules directories')
+    parser.add_argument('--no-gitignore', action='store_true',
+                        help='Walk the files ignored by .gitignore files too')
+    parser.add_argument('-L', '--follow-links', action='store_true',
+                        help='Follow directory symlinks (each directory is walked once)')
     parser.add_argument('-e', '--exclude', nargs='+', metavar=('EXCLUDE_LIST'), type=str,
                     help='Exclude list')
+    parser.add_argument('-l', '--locations', action='store_true',
+                        help='Print the file:line of every import of the reported modules')
+    parser.add_argument('-c', '--cache', metavar=('FILE'), type=str, nargs='?', const='',
+                        help='Keep the imports of every file in FILE (default: %s in DIR) '
+                             'and only rescan the files changed since the last run' % cache_file_name)
+    parser.add_argument('-g', '--changed-since', metavar=('REF'), type=str,
+                        help='Only scan the files changed since the git REF')
+    parser.add_argument('-j', '--jobs', metavar=('JOBS'), type=int,
+                        help='Number of worker processes scanning files (default: one per CPU)')
+    parser.add_argument('-P', '--profile', choices=instrument.output_formats,
+                        help='Print phase timings and counters to stderr (or set PKGTOOLS_PROFILE)')
+    parser.add_argument('--profile-dump', metavar=('FILE'), type=str,
+                        help='Write cProfile stats to FILE (or set PKGTOOLS_PROFILE_DUMP)')
 
     args = parser.parse_args()
 
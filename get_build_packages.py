@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 """Working with packages"""
 
-import apt
 import argparse
+import debindex
+import debversion
+import instrument
+import json
 import os
+import pkgindex
 import re
 import sys
-import yaml
 from cStringIO import StringIO
 from subprocess import Popen, PIPE
 
@@ -22,6 +25,18 @@ valid_req_line_re = re.compile('^[A-z0-9-.<>=,!]+')
 req_name_re = re.compile('^[A-z0-9-.]+')
 req_version_re = re.compile('([0-9-.<>=,!]+)?$')
 pkg_uri_re = re.compile('^(https?://[A-z0-9-.:]+/)')
+# Package index snapshot compiled by pkgver.py -c into cache/<version>.
+index_file_name = 'pkgindex.bin'
+
+# Relation fields checked by the control file audit.
+source_fields = ['Build-Depends', 'Build-Depends-Indep', 'Build-Depends-Arch']
+binary_fields = ['Pre-Depends', 'Depends']
+control_fields = frozenset(['Source', 'Package'] + source_fields + binary_fields)
+
+# PEP 503 name normalization, and the prefixes Debian puts before the
+# normalized name of a Python distribution.
+name_separators_re = re.compile('[-_.]+')
+python_prefixes = ['python-', 'python3-', '']
 
 class TrustyPackages:
 
@@ -35,6 +50,8 @@ class TrustyPackages:
         self.control_mem = ''
         self.packages_in_control = []
         self.control_parsed = ''
+        self.version_lists = {}
+        self.relation_status = {}
 
     def get_packages(self, line):
         """Docstring"""
@@ -84,6 +101,8 @@ class TrustyPackages:
                 self.control_mem.write('%s' % line)
             self.control = self.control_mem.getvalue()
             self.control_mem.close()
+            import yaml
+            from yaml.scanner import ScannerError
             try:
                 self.control_parsed = yaml.safe_load(self.control)
             except ScannerError:
@@ -129,6 +148,8 @@ class TrustyPackages:
 
     def load_accordance_dictionary(self, dict_file):
         """Docstring."""
+        import yaml
+        from yaml.scanner import ScannerError
         with open(dict_file, 'r') as dict_yaml:
             try:
                 self.accordance_dictionary = yaml.safe_load(dict_yaml)
@@ -150,6 +171,8 @@ class TrustyPackages:
                     self.requirements_doc[name] = version.split(',')
 
     def prepare_apt(self, version, update_cache=False, cache_path='cache'):
+        # python-apt is slow to import and not needed with --indexes.
+        import apt
         try:
             current_dir = os.getcwd()
         except:
@@ -212,46 +235,392 @@ deb http://obs-1.mirantis.com:82/trusty-fuel-{version}-stable/ubuntu/ ./
             file.write(sources)
             file.close()
 
-        cache = apt.cache.Cache(rootdir=path_to_cache)
+        with instrument.phase('cache open'):
+            cache = apt.cache.Cache(rootdir=path_to_cache)
 
         if update_cache:
-            cache.update()
+            with instrument.phase('cache update'):
+                cache.update()
 
         return cache
 
+    def get_version_list(self, repo_cache, package_name):
+        """Return the sorted VersionList of package_name in repo_cache."""
+        if package_name not in self.version_lists:
+            instrument.count('cache lookups')
+            self.version_lists[package_name] = debversion.VersionList(
+                [version.version for version in repo_cache[package_name].versions])
+        return self.version_lists[package_name]
+
+    def check_relation(self, repo_cache, alternatives):
+        """Return (status, version) of an or-group of (name, relation,
+        version) alternatives in repo_cache.
+
+        Status is 'satisfied' (with the satisfying version), 'unsatisfied'
+        (with the newest version of the first packaged alternative) or
+        'absent'. Results are kept for the whole audit.
+        """
+        key = tuple(alternatives)
+        if key in self.relation_status:
+            return self.relation_status[key]
+
+        status = ('absent', '')
+        for name, relation, version in alternatives:
+            if name in repo_cache:
+                versions = self.get_version_list(repo_cache, name)
+                matching = versions.satisfying(relation, version)
+                if matching:
+                    status = ('satisfied', matching[-1])
+                    break
+                if status[0] == 'absent':
+                    status = ('unsatisfied', versions.newest())
+
+            for provider, provider_version, provided_version in pkgindex.get_providers(repo_cache, name):
+                if not relation or (provided_version and debversion.satisfies(provided_version, relation, version)):
+                    status = ('satisfied', '%s %s' % (provider, provider_version))
+                    break
+            if status[0] == 'satisfied':
+                break
+
+        instrument.count('relations checked')
+        self.relation_status[key] = status
+        return status
+
+    def audit_controls(self, directory, repo_cache, jobs=None):
+        """Check the relations of every debian/control file under directory.
+
+        Control files are parsed in a pool of jobs worker processes and
+        checked here against repo_cache. Returns a report dict with the
+        problems of each file, a summary and the absent packages ordered
+        by the number of relations needing them.
+        """
+        with instrument.phase('control search'):
+            control_files = find_control_files(directory)
+        instrument.count('control files scanned', len(control_files))
+        import multiprocessing
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+
+        with instrument.phase('control parse'):
+            if jobs > 1 and len(control_files) > 1:
+                pool = multiprocessing.Pool(min(jobs, len(control_files)))
+                try:
+                    parsed = pool.map(parse_control_file, control_files, chunksize=16)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                parsed = [parse_control_file(control_file) for control_file in control_files]
+
+        summary = {'Files': len(control_files), 'Errors': 0, 'Relations': 0,
+                   'Satisfied': 0, 'Unsatisfied': 0, 'Absent': 0}
+        absent = {}
+        files = []
+        for control_file, relations, error in parsed:
+            record = {'File': control_file, 'Problems': []}
+            files.append(record)
+            if error:
+                record['Error'] = error
+                summary['Errors'] += 1
+                continue
+
+            for package_name, field, groups in relations:
+                for alternatives in groups:
+                    status, version = self.check_relation(repo_cache, alternatives)
+                    summary['Relations'] += 1
+                    summary[status.capitalize()] += 1
+                    if status == 'satisfied':
+                        continue
+
+                    if status == 'absent':
+                        for name in set(alternative[0] for alternative in alternatives):
+                            absent[name] = absent.get(name, 0) + 1
+                    record['Problems'].append({'Package': package_name, 'Field': field,
+                                               'Relation': format_relation(alternatives),
+                                               'Status': status, 'Version': version})
+
+        return {'Files': files, 'Summary': summary,
+                'Absent': sorted(absent.items(), key=lambda item: (-item[1], item[0]))}
+
+def find_control_files(directory):
+    """Return every debian/control file under directory, skipping dot directories."""
+    control_files = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        if os.path.basename(root) == 'debian' and 'control' in files:
+            control_files.append(os.path.join(root, 'control'))
+    return control_files
+
+def parse_control_file(control_file):
+    """Return (control file, relations, error) for one control file.
+
+    relations holds (package, field, or-groups) for the build relations
+    of the source stanza and the Pre-Depends/Depends of every binary
+    stanza; substitution variables such as ${misc:Depends} are skipped.
+    """
+    relations = []
+    try:
+        control = debindex.open_index(control_file)
+        try:
+            for stanza in debindex.iter_stanzas(control, control_fields):
+                if 'Source' in stanza:
+                    package_name, fields = stanza['Source'], source_fields
+                else:
+                    package_name, fields = stanza.get('Package', ''), binary_fields
+                for field in fields:
+                    if field in stanza:
+                        relations.append((package_name, field, debindex.parse_relations(stanza[field])))
+        finally:
+            control.close()
+    except (IOError, OSError) as error:
+        return control_file, [], str(error)
+
+    return control_file, relations, None
+
+def format_relation(alternatives):
+    """Format an or-group back into control file syntax."""
+    relations = {'<': '<<', '>': '>>'}
+    return ' | '.join('%s (%s %s)' % (name, relations.get(relation, relation), version) if relation else name
+                      for name, relation, version in alternatives)
+
+def print_audit(report):
+    """Print an audit_controls report as text."""
+    for record in report['Files']:
+        if record.get('Error'):
+            print '%s: %s' % (record['File'], record['Error'])
+        elif record['Problems']:
+            print record['File'] + ':'
+            for problem in record['Problems']:
+                print '  %(Package)s %(Field)s: %(Relation)s - %(Status)s' % problem + \
+                    (' (%s)' % problem['Version'] if problem['Version'] else '')
+
+    if report['Absent']:
+        print 'Absent packages:'
+        for name, count in report['Absent']:
+            print '  %s: %d' % (name, count)
+
+    print ('%(Files)d control files, %(Errors)d unreadable; %(Relations)d relations: '
+           '%(Satisfied)d satisfied, %(Unsatisfied)d unsatisfied, %(Absent)d absent' % report['Summary'])
+
+def normalize_name(name):
+    """Return the PEP 503 normalized form of a requirement or package name."""
+    return name_separators_re.sub('-', name).lower()
+
+def get_trigrams(name):
+    padded = ' %s ' % name
+    return frozenset(padded[position:position + 3] for position in range(len(padded) - 2))
+
+def strip_python_prefix(name):
+    for prefix in python_prefixes[:-1]:
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return name
+
+class AccordanceIndex(object):
+
+    """Requirement to package name lookups over the accordance dictionary
+
+    A requirement is looked up as written, then PEP 503 normalized (so
+    Babel finds babel and dogpile.cache finds dogpile-cache), then as
+    python-, python3- or bare normalized names of the repository
+    packages. The repository name maps and the trigram index behind
+    suggest() are built on their first use, since most requirements are
+    found in the dictionary.
+    """
+
+    def __init__(self, accordance_dictionary, repo_cache=None):
+        self.accordance_dictionary = accordance_dictionary or {}
+        self.repo_cache = repo_cache
+        self.normalized = {}
+        for requirement, package_name in sorted(self.accordance_dictionary.items()):
+            self.normalized.setdefault(normalize_name(str(requirement)), package_name)
+        self.repo_names = None
+        self.trigrams = None
+        self.name_trigrams = None
+
+    def get_repo_names(self):
+        """Return the normalized name -> name dict of the repository and dictionary packages."""
+        if self.repo_names is None:
+            names = set(name for name in self.accordance_dictionary.values() if name)
+            if self.repo_cache is not None:
+                names.update(self.repo_cache.keys())
+            self.repo_names = {}
+            for name in sorted(names):
+                self.repo_names.setdefault(normalize_name(name), name)
+        return self.repo_names
+
+    def lookup(self, requirement):
+        """Return (package name, match) for requirement, or (None, None).
+
+        match is 'exact' or 'normalized' for dictionary entries and
+        'repository' for names guessed from the repository packages.
+        """
+        if requirement in self.accordance_dictionary:
+            return self.accordance_dictionary[requirement], 'exact'
+
+        normalized_name = normalize_name(requirement)
+        if normalized_name in self.normalized:
+            return self.normalized[normalized_name], 'normalized'
+
+        if self.repo_cache is not None:
+            repo_names = self.get_repo_names()
+            for prefix in python_prefixes:
+                if prefix + normalized_name in repo_names:
+                    return repo_names[prefix + normalized_name], 'repository'
+
+        return None, None
+
+    def suggest(self, requirement, limit=5, threshold=0.3):
+        """Return up to limit package names resembling requirement, best first.
+
+        Names are compared by the trigrams of their normalized form
+        without the python- or python3- prefix.
+        """
+        if self.trigrams is None:
+            self.trigrams = {}
+            self.name_trigrams = {}
+            for normalized_name, name in self.get_repo_names().items():
+                trigrams = get_trigrams(strip_python_prefix(normalized_name))
+                self.name_trigrams[name] = len(trigrams)
+                for trigram in trigrams:
+                    self.trigrams.setdefault(trigram, []).append(name)
+
+        trigrams = get_trigrams(strip_python_prefix(normalize_name(requirement)))
+        common = {}
+        for trigram in trigrams:
+            for name in self.trigrams.get(trigram, ()):
+                common[name] = common.get(name, 0) + 1
+
+        scores = []
+        for name, count in common.items():
+            score = float(count) / (len(trigrams) + self.name_trigrams[name] - count)
+            if score >= threshold:
+                scores.append((-score, name))
+        return [name for _, name in sorted(scores)[:limit]]
+
+def madison(repo_cache, names):
+    """Return the apt-cache madison records of names, looked up in repo_cache.
+
+    There is one record per version and origin of every binary package,
+    followed by the versions of the source package of that name when
+    repo_cache has Sources (index files read with --indexes).
+    """
+    sources = getattr(repo_cache, 'sources', None) or {}
+    records = []
+    for name in names:
+        if name in repo_cache:
+            for version in repo_cache[name].versions:
+                for origin in version.origins or [None]:
+                    records.append({'Package': name, 'Version': version.version,
+                                    'Uri': pkgindex.get_archive_uri(version, origin),
+                                    'Suite': origin.archive if origin is not None else '',
+                                    'Component': origin.component if origin is not None else '',
+                                    'Architecture': version.architecture, 'Type': 'Packages'})
+        for source in sources.get(name, []):
+            records.append({'Package': name, 'Version': source.version,
+                            'Uri': source.origin[4],
+                            'Suite': source.origin[1], 'Component': source.origin[0],
+                            'Architecture': '', 'Type': 'Sources'})
+    return records
+
+def system_madison(names):
+    """Return the madison records of names from the system apt cache.
+
+    All names are asked in one apt-cache run.
+    """
+    proc = Popen(['apt-cache', 'madison'] + list(names), stdout=PIPE, stderr=PIPE)
+    records = []
+    for line in proc.communicate()[0].splitlines():
+        fields = [field.strip() for field in line.split('|', 2)]
+        if len(fields) < 3:
+            continue
+        words = fields[2].split()
+        suite, component = (words[1].split('/', 1) + [''])[:2] if len(words) > 1 else ('', '')
+        records.append({'Package': fields[0], 'Version': fields[1], 'Uri': words[0] if words else '',
+                        'Suite': suite.strip('.'), 'Component': component,
+                        'Architecture': words[2] if len(words) > 3 else '',
+                        'Type': words[-1] if words else ''})
+    return records
+
+def format_madison(records):
+    """Format madison records the way apt-cache madison prints them."""
+    lines = []
+    for record in records:
+        if record['Suite']:
+            distribution = '%s/%s' % (record['Suite'], record['Component']) if record['Component'] else record['Suite']
+        else:
+            # Flat repositories ("deb URI ./").
+            distribution = './'
+        words = [record['Uri'], distribution]
+        if record['Type'] == 'Packages' and record['Architecture']:
+            words.append(record['Architecture'])
+        words.append(record['Type'])
+        lines.append('%10s | %10s | %s' % (record['Package'], record['Version'], ' '.join(word for word in words if word)))
+    return '\n'.join(lines)
+
 def main(args):
+    instrument.configure(args.profile, args.profile_dump)
     packages = TrustyPackages()
-    if args.fuel_version:
-        repo_cache = packages.prepare_apt(args.fuel_version, args.update_cache)
-    packages.prepare_control(args.control_file_location)
+    repo_cache = None
+    if args.indexes:
+        with instrument.phase('index files load'):
+            repo_cache = debindex.load_cache(args.indexes)
+    elif args.fuel_version:
+        path_to_index = os.path.join('cache', args.fuel_version, index_file_name)
+        if not args.update_cache and not args.no_index and os.path.exists(path_to_index):
+            try:
+                with instrument.phase('snapshot open'):
+                    repo_cache = pkgindex.PackageIndex(path_to_index)
+            except ValueError:
+                # Written by an older format; use python-apt.
+                pass
+        if repo_cache is None:
+            repo_cache = packages.prepare_apt(args.fuel_version, args.update_cache)
+
+    if args.audit:
+        with instrument.phase('audit'):
+            report = packages.audit_controls(args.audit, repo_cache, args.jobs)
+        with instrument.phase('output'):
+            if args.output == 'json':
+                print json.dumps(report, sort_keys=True)
+            else:
+                print_audit(report)
+        repo_cache.close()
+        instrument.report()
+        return
+
+    with instrument.phase('control parse'):
+        packages.prepare_control(args.control_file_location)
 
     if args.requirements:
-        packages.load_accordance_dictionary('accordance_dictionary.yaml')
-        packages.parse_requirements(args.requirements)
-        packages.build_dependencies(args.debug)
-        packages.packages_build_dependencies(args.debug)
-        packages.packages_in_control.append('source_package')
+        with instrument.phase('requirements parse'):
+            packages.load_accordance_dictionary('accordance_dictionary.yaml')
+            packages.parse_requirements(args.requirements)
+            packages.build_dependencies(args.debug)
+            packages.packages_build_dependencies(args.debug)
+            packages.packages_in_control.append('source_package')
+            index = AccordanceIndex(packages.accordance_dictionary, repo_cache)
 
         for required_package in packages.requirements_doc:
+            instrument.count('requirements checked')
 
-            if required_package in packages.accordance_dictionary:
-                pkg_name = packages.accordance_dictionary[required_package]
+            pkg_name, match = index.lookup(required_package)
+            if pkg_name:
+                instrument.count('%s matches' % match)
+                if args.debug and match == 'repository':
+                    print('Not in a dictionary, found in the repository:\n{required_package}: {package_name}'.format(package_name=pkg_name, required_package=required_package))
                 if repo_cache and (pkg_name in repo_cache):
                     pkg_in_repo = repo_cache[pkg_name]
                     if repo_cache.is_virtual_package(pkg_name):
                         print('ATTENTION: Package is Virtual!')
                     for package in pkg_in_repo.versions:
-                        pkg_uri_match = pkg_uri_re.match(package.uri)
-                        if pkg_uri_match:
-                            pkg_uri = pkg_uri_match.group()
-                        else:
-                            pkg_uri = package.uri
+                        # Snapshot versions have no uri; their origins do.
+                        pkg_uri = pkgindex.get_archive_uri(package)
                         print('r: {package_version} ({package_uri})'.format(package_uri=pkg_uri, package_version=package.version))
             else:
                 if args.debug:
-                    for package in repo_cache:
-                        if required_package.lower() in package.name:
-                            print('Possible package name:\n{required_package}: {package_name}'.format(package_name=package.name, required_package=required_package))
+                    for package_name in index.suggest(required_package):
+                        print('Possible package name:\n{required_package}: {package_name}'.format(package_name=package_name, required_package=required_package))
                     print 'Not in a dictionary: ' + required_package
                 pkg_name = required_package
 
@@ -262,25 +631,64 @@ def main(args):
                     packages.requirements_doc[required_package], '<===>', \
                     pkg_name, packages.package_dic[package_name][pkg_name]
     else:
-        for package in packages.package_dic.keys():
-            proc = Popen(['apt-cache', 'madison', package], stdout=PIPE,\
-                         stderr=PIPE)
-            stdout_value = proc.communicate()[0]
-            print stdout_value
+        with instrument.phase('control parse'):
+            packages.build_dependencies(args.debug)
+            packages.packages_build_dependencies(args.debug)
+        names = []
+        seen = set()
+        for package_name in ['source_package'] + packages.packages_in_control:
+            for name in sorted(packages.package_dic.get(package_name, {})):
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+
+        # One pass over every dependency of the control file, answered
+        # from the opened cache instead of an apt-cache run per package.
+        with instrument.phase('madison'):
+            if repo_cache is not None:
+                records = madison(repo_cache, names)
+            else:
+                records = system_madison(names)
+        instrument.count('madison packages', len(names))
+        instrument.count('madison records', len(records))
+        with instrument.phase('output'):
+            if args.output == 'json':
+                print json.dumps(records, sort_keys=True)
+            elif records:
+                print format_madison(records)
 
     if repo_cache:
         repo_cache.close()
 
+    instrument.report()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Get deploy tasks by role.')
     parser.add_argument("control_file_location", type=str, help="Path to the\
-                         control file", default='debian/control')
+                         control file", nargs='?', default='debian/control')
     parser.add_argument('-r', '--requirements', metavar=('REQS'), type=str,
-                        help='requirements file location', default='reqs')
+                        help='Requirements file location. Without it the repository versions '
+                             'of the control file dependencies are listed, like apt-cache madison '
+                             '(it used to default to ./reqs)')
     parser.add_argument('-f', '--fuel-version', metavar=('FVER'), type=str,
                         help='Fuel version', default='7.0')
     parser.add_argument('-u', '--update-cache', action='store_true',
                         help='Force cache update')
+    parser.add_argument('-I', '--indexes', metavar=('DIR'), type=str,
+                        help='Read Packages/Sources files from DIR instead of python-apt')
+    parser.add_argument('-n', '--no-index', action='store_true',
+                        help='Ignore the package index snapshot of pkgver.py and use python-apt')
+    parser.add_argument('-a', '--audit', metavar=('DIR'), type=str,
+                        help='Check every debian/control file under DIR')
+    parser.add_argument('-j', '--jobs', metavar=('JOBS'), type=int,
+                        help='Number of worker processes')
+    parser.add_argument('-o', '--output', choices=['text', 'json'], default='text',
+                        help='Format of the audit report and of the package versions '
+                             '(text is apt-cache madison compatible)')
+    parser.add_argument('-P', '--profile', choices=instrument.output_formats,
+                        help='Print phase timings and counters to stderr (or set PKGTOOLS_PROFILE)')
+    parser.add_argument('--profile-dump', metavar=('FILE'), type=str,
+                        help='Write cProfile stats to FILE (or set PKGTOOLS_PROFILE_DUMP)')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Verbosity level')
     parser.add_argument('-i', '--info', action='version',
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Optional phase timers, counters and cProfile dumps.
+
+Instrumentation is off unless configure() is given an output format or
+a dump file, or the PKGTOOLS_PROFILE ('table' or 'json') and
+PKGTOOLS_PROFILE_DUMP (cProfile stats file) environment variables are
+set. While it is off, phase() and count() do next to nothing. Only the
+calling process is measured, not pool workers.
+
+The stats are reported by report(), or at exit when a run stops before
+calling it (sys.exit on errors).
+"""
+
+import atexit
+import json
+import os
+import sys
+import time
+
+output_formats = ['table', 'json']
+
+
+class NullPhase(object):
+
+    """Phase context used while instrumentation is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_phase = NullPhase()
+
+
+class Phase(object):
+
+    """Context adding its duration to a named phase"""
+    __slots__ = ('instrument', 'name', 'started')
+
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrument.add_time(self.name, time.time() - self.started)
+        return False
+
+
+class Instrument(object):
+
+    """Phase timers and counters of one process"""
+
+    def __init__(self):
+        self.enabled = False
+        self.output = 'table'
+        self.started = None
+        self.phases = {}
+        self.phase_order = []
+        self.counters = {}
+        self.profiler = None
+        self.dump_path = None
+        self.reported = False
+
+    def enable(self, output='table', dump_path=None):
+        if self.started is None:
+            atexit.register(self.report)
+        self.enabled = True
+        self.reported = False
+        self.output = output
+        self.started = time.time()
+        if dump_path:
+            import cProfile
+            self.dump_path = dump_path
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def phase(self, name):
+        if not self.enabled:
+            return null_phase
+        return Phase(self, name)
+
+    def add_time(self, name, elapsed):
+        if name not in self.phases:
+            self.phases[name] = [0, 0.0]
+            self.phase_order.append(name)
+        self.phases[name][0] += 1
+        self.phases[name][1] += elapsed
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stats(self):
+        """Return the phases, counters and wall time as a dict."""
+        counters = dict(self.counters)
+        # Version comparisons are counted by debversion itself.
+        debversion = sys.modules.get('debversion')
+        if debversion is not None:
+            for name, value in debversion.comparator.stats().items():
+                counters['Version ' + name.lower()] = value
+
+        return {'Wall': time.time() - self.started,
+                'Phases': [{'Phase': name, 'Calls': self.phases[name][0], 'Time': self.phases[name][1]}
+                           for name in self.phase_order],
+                'Counters': counters}
+
+    def report(self, stream=sys.stderr):
+        """Write the collected stats to stream and the cProfile dump, if any."""
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.dump_path)
+
+        stats = self.stats()
+        if self.output == 'json':
+            stream.write(json.dumps(stats, sort_keys=True) + '\n')
+            return
+
+        wall = stats['Wall'] or 1.0
+        lines = ['%-28s %8s %10s %6s' % ('Phase', 'Calls', 'Time', '%')]
+        for phase in stats['Phases']:
+            lines.append('%-28s %8d %9.3fs %5.1f%%' % (phase['Phase'], phase['Calls'], phase['Time'],
+                                                      100.0 * phase['Time'] / wall))
+        lines.append('%-28s %8s %9.3fs' % ('Wall', '', stats['Wall']))
+        lines.append('')
+        lines.append('%-28s %8s' % ('Counter', 'Value'))
+        for name in sorted(stats['Counters']):
+            lines.append('%-28s %8d' % (name, stats['Counters'][name]))
+        if self.dump_path:
+            lines.append('')
+            lines.append('cProfile stats written to %s' % self.dump_path)
+        stream.write('\n'.join(lines) + '\n')
+
+
+instrument = Instrument()
+
+
+def configure(output=None, dump_path=None):
+    """Enable instrumentation from command line values or the environment."""
+    output = output or os.environ.get('PKGTOOLS_PROFILE')
+    dump_path = dump_path or os.environ.get('PKGTOOLS_PROFILE_DUMP')
+    if output or dump_path:
+        instrument.enable(output if output in output_formats else 'table', dump_path)
+
+
+def phase(name):
+    """Return a context manager timing the named phase."""
+    return instrument.phase(name)
+
+
+def count(name, value=1):
+    instrument.count(name, value)
+
+
+def report(stream=sys.stderr):
+    instrument.report(stream)
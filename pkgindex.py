@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+"""Compact memory-mapped package index snapshot.
+
+A snapshot holds only what the tools query from an apt cache: package
+names, versions, source names, architectures, origins, dependency
+triples, Provides, and the reverse dependency and provider indexes built
+from them. Every string
+is stored once in a string table and all records are fixed-size and
+addressed by offset, so a snapshot is opened with a single mmap and
+queried without building the cache in memory.
+
+Layout (all integers are little-endian uint32):
+
+    header    MAGIC, FORMAT, section counts and offsets
+    strings   count + 1 offsets into the blob, then the blob itself
+    packages  name, first version, version count (sorted by name)
+    versions  version, source name, architecture, first origin,
+              origin count, first group, group count, first provide,
+              provide count
+    origins   component, archive, site, origin, archive uri
+    groups    first dependency, dependency count (one per or-group)
+    deps      name, relation, version
+    provides  name, version
+    targets   name, first reverse dependency, count (sorted by name)
+    rdeps     dependent package, dependent version, relation, version
+    provided  name, first provider, count (sorted by name)
+    providers provider package, provider version, provided version
+"""
+
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'PKGIDX'
+FORMAT = 4
+
+header_struct = struct.Struct('<6sH22I')
+package_struct = struct.Struct('<3I')
+version_struct = struct.Struct('<9I')
+origin_struct = struct.Struct('<5I')
+group_struct = struct.Struct('<2I')
+dep_struct = struct.Struct('<3I')
+target_struct = struct.Struct('<3I')
+rdep_struct = struct.Struct('<4I')
+provide_struct = struct.Struct('<2I')
+provider_struct = struct.Struct('<3I')
+offset_struct = struct.Struct('<I')
+
+if sys.version_info[0] >= 3:
+    def to_text(value):
+        return value.decode('utf-8')
+else:
+    def to_text(value):
+        return value
+
+
+def to_bytes(value):
+    """Encode value for the string table."""
+    if value is None:
+        value = ''
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+
+def get_provides(version):
+    """Return the (name, version) pairs a package version provides."""
+    if hasattr(version, 'provides_list'):
+        return [provide[:2] for provide in version.provides_list]
+    # apt.package.Version only exposes the names; the versions are on
+    # the underlying apt_pkg.Version.
+    raw_version = getattr(version, '_cand', None)
+    if raw_version is not None:
+        return [provide[:2] for provide in raw_version.provides_list]
+    return [(name, '') for name in getattr(version, 'provides', [])]
+
+
+def get_archive_uri(version, origin=None):
+    """Return the root URI of the archive version was found in, as apt-cache madison shows it.
+
+    origin defaults to the first origin of version. Snapshot and index
+    file origins know the URI; with python-apt it is taken from the URI
+    of the .deb.
+    """
+    if origin is None and version.origins:
+        origin = version.origins[0]
+    uri = getattr(origin, 'uri', None)
+    if uri:
+        return uri
+    uri = getattr(version, 'uri', None) or ''
+    if '/pool/' in uri:
+        return uri.split('/pool/', 1)[0]
+    return uri.rsplit('/', 1)[0]
+
+
+class IndexOrigin(object):
+
+    """Origin of a package version, as in apt.package.Origin, with the
+    root URI of its archive"""
+    __slots__ = ('component', 'archive', 'site', 'origin', 'uri')
+
+    def __init__(self, component, archive, site, origin, uri):
+        self.component = component
+        self.archive = archive
+        self.site = site
+        self.origin = origin
+        self.uri = uri
+
+
+class IndexDependency(object):
+
+    """One alternative of a dependency, as in apt.package.BaseDependency"""
+    __slots__ = ('name', 'relation', 'version')
+
+    def __init__(self, name, relation, version):
+        self.name = name
+        self.relation = relation
+        self.version = version
+
+
+class IndexVersion(object):
+
+    """Package version backed by a snapshot record"""
+
+    def __init__(self, index, record):
+        self._index = index
+        (version, source_name, architecture, self._first_origin, self._origins,
+         self._first_group, self._groups, self._first_provide, self._provides) = record
+        self.version = index.string(version)
+        self.source_name = index.string(source_name)
+        self.architecture = index.string(architecture)
+
+    @property
+    def origins(self):
+        return [self._index.origin(number) for number in
+                range(self._first_origin, self._first_origin + self._origins)]
+
+    @property
+    def dependencies(self):
+        return [self._index.group(number) for number in
+                range(self._first_group, self._first_group + self._groups)]
+
+    @property
+    def provides_list(self):
+        return [self._index.provide(number) for number in
+                range(self._first_provide, self._first_provide + self._provides)]
+
+
+class IndexPackage(object):
+
+    """Package backed by a snapshot record"""
+
+    def __init__(self, index, name, first_version, versions):
+        self._index = index
+        self.name = name
+        self._first_version = first_version
+        self._versions = versions
+
+    @property
+    def versions(self):
+        return [self._index.version(number) for number in
+                range(self._first_version, self._first_version + self._versions)]
+
+
+class PackageIndex(object):
+
+    """Read-only view of a snapshot written by compile_index.
+
+    Supports the subset of the apt.cache.Cache interface the tools use:
+    membership, item access, keys(), iteration, len() and close().
+    """
+
+    def __init__(self, path):
+        """Open the snapshot at path.
+
+        Raises ValueError for files of another format and truncated ones,
+        which callers rebuild.
+        """
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self.read_header()
+        except struct.error:
+            self._map.close()
+            raise ValueError('%s is truncated' % path)
+        except ValueError:
+            self._map.close()
+            raise
+        self._lookup = {}
+
+    def read_header(self):
+        header = header_struct.unpack_from(self._map, 0)
+        if header[0] != MAGIC or header[1] != FORMAT:
+            raise ValueError('%s is not a package index snapshot' % self.path)
+
+        (self._strings, self._strings_offset, self._packages, self._packages_offset,
+         self._versions, self._versions_offset, self._origins, self._origins_offset,
+         self._groups, self._groups_offset, self._deps, self._deps_offset,
+         self._provides, self._provides_offset, self._targets, self._targets_offset,
+         self._rdeps, self._rdeps_offset, self._provided, self._provided_offset,
+         self._providers, self._providers_offset) = header[2:]
+        self._blob_offset = self._strings_offset + offset_struct.size * (self._strings + 1)
+
+        # Check that every section fits, so that a truncated file fails
+        # here rather than on some later lookup.
+        blob_size = offset_struct.unpack_from(self._map, self._blob_offset - offset_struct.size)[0]
+        sections = [(self._packages, self._packages_offset, package_struct),
+                    (self._versions, self._versions_offset, version_struct),
+                    (self._origins, self._origins_offset, origin_struct),
+                    (self._groups, self._groups_offset, group_struct),
+                    (self._deps, self._deps_offset, dep_struct),
+                    (self._provides, self._provides_offset, provide_struct),
+                    (self._targets, self._targets_offset, target_struct),
+                    (self._rdeps, self._rdeps_offset, rdep_struct),
+                    (self._provided, self._provided_offset, target_struct),
+                    (self._providers, self._providers_offset, provider_struct)]
+        ends = [self._blob_offset + blob_size] + [offset + count * record_struct.size
+                                                  for count, offset, record_struct in sections]
+        if max(ends) > len(self._map):
+            raise ValueError('%s is truncated' % self.path)
+
+    def string(self, number):
+        start, end = struct.unpack_from('<2I', self._map, self._strings_offset + offset_struct.size * number)
+        return to_text(self._map[self._blob_offset + start:self._blob_offset + end])
+
+    def origin(self, number):
+        record = origin_struct.unpack_from(self._map, self._origins_offset + origin_struct.size * number)
+        return IndexOrigin(*[self.string(field) for field in record])
+
+    def group(self, number):
+        first, count = group_struct.unpack_from(self._map, self._groups_offset + group_struct.size * number)
+        group = []
+        for dep in range(first, first + count):
+            record = dep_struct.unpack_from(self._map, self._deps_offset + dep_struct.size * dep)
+            group.append(IndexDependency(*[self.string(field) for field in record]))
+        return group
+
+    def provide(self, number):
+        record = provide_struct.unpack_from(self._map, self._provides_offset + provide_struct.size * number)
+        return tuple(self.string(field) for field in record)
+
+    def version(self, number):
+        return IndexVersion(self, version_struct.unpack_from(self._map, self._versions_offset + version_struct.size * number))
+
+    def package(self, number):
+        name, first_version, versions = package_struct.unpack_from(self._map, self._packages_offset + package_struct.size * number)
+        return IndexPackage(self, self.string(name), first_version, versions)
+
+    def package_name(self, number):
+        name = offset_struct.unpack_from(self._map, self._packages_offset + package_struct.size * number)[0]
+        return self.string(name)
+
+    def find(self, name):
+        """Return the package number of name, or None (binary search)."""
+        if name in self._lookup:
+            return self._lookup[name]
+
+        low, high = 0, self._packages
+        while low < high:
+            middle = (low + high) // 2
+            if self.package_name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._packages and self.package_name(low) == name:
+            number = low
+        else:
+            number = None
+        self._lookup[name] = number
+        return number
+
+    def lookup_table(self, table_offset, table_size, records_offset, record_struct, name):
+        """Binary search name in a (name, first, count) table and return the
+        string tuples of its records."""
+        low, high = 0, table_size
+        while low < high:
+            middle = (low + high) // 2
+            target = offset_struct.unpack_from(self._map, table_offset + target_struct.size * middle)[0]
+            if self.string(target) < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == table_size:
+            return []
+        target, first, count = target_struct.unpack_from(self._map, table_offset + target_struct.size * low)
+        if self.string(target) != name:
+            return []
+
+        return [tuple(self.string(field) for field in
+                      record_struct.unpack_from(self._map, records_offset + record_struct.size * number))
+                for number in range(first, first + count)]
+
+    def reverse_dependencies(self, name):
+        """Return (dependent, dependent version, relation, version) tuples of
+        every package version depending on name."""
+        return self.lookup_table(self._targets_offset, self._targets, self._rdeps_offset, rdep_struct, name)
+
+    def providers(self, name):
+        """Return (provider, provider version, provided version) tuples of
+        every package version providing name."""
+        return self.lookup_table(self._provided_offset, self._provided, self._providers_offset, provider_struct, name)
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __getitem__(self, name):
+        number = self.find(name)
+        if number is None:
+            raise KeyError(name)
+        return self.package(number)
+
+    def __len__(self):
+        return self._packages
+
+    def __iter__(self):
+        for number in range(self._packages):
+            yield self.package(number)
+
+    def keys(self):
+        return [self.package_name(number) for number in range(self._packages)]
+
+    def is_virtual_package(self, name):
+        return name not in self and bool(self.providers(name))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class DependencyIndex(object):
+
+    """In-memory reverse dependency and provider index of a Deb822Cache or
+    python-apt cache"""
+
+    def __init__(self, cache):
+        self.dependents = {}
+        self.provided = {}
+        for package in cache:
+            for version in package.versions:
+                for dependencies in version.dependencies:
+                    for dependency in dependencies:
+                        self.dependents.setdefault(dependency.name, []).append(
+                            (package.name, version.version, dependency.relation, dependency.version))
+                for name, provided_version in get_provides(version):
+                    self.provided.setdefault(name, []).append(
+                        (package.name, version.version, provided_version or ''))
+
+    def reverse_dependencies(self, name):
+        return self.dependents.get(name, [])
+
+    def providers(self, name):
+        return self.provided.get(name, [])
+
+
+def get_providers(cache, name):
+    """Return the (provider, provider version, provided version) tuples of
+    every package version providing name in cache.
+
+    python-apt indexes Provides already (apt_pkg.Package.provides_list),
+    so a DependencyIndex is only built for the other caches.
+    """
+    raw_cache = getattr(cache, '_cache', None)
+    if raw_cache is None or hasattr(cache, 'providers'):
+        return get_dependency_index(cache).providers(name)
+
+    try:
+        raw_package = raw_cache[name]
+    except KeyError:
+        return []
+    return [(raw_version.parent_pkg.name, raw_version.ver_str, provided_version or '')
+            for provided_name, provided_version, raw_version in raw_package.provides_list]
+
+
+def get_dependency_index(cache):
+    """Return an object answering reverse_dependencies(name) and
+    providers(name) for cache.
+
+    Snapshots carry both indexes already; for other caches they are built
+    once and kept with the cache object.
+    """
+    if hasattr(cache, 'reverse_dependencies') and hasattr(cache, 'providers'):
+        return cache
+    if getattr(cache, '_pkgtools_dependency_index', None) is None:
+        cache._pkgtools_dependency_index = DependencyIndex(cache)
+    return cache._pkgtools_dependency_index
+
+
+class StringTable(object):
+
+    """Interning string table used while compiling a snapshot"""
+
+    def __init__(self):
+        self.numbers = {}
+        self.strings = []
+
+    def add(self, value):
+        value = to_bytes(value)
+        number = self.numbers.get(value)
+        if number is None:
+            number = self.numbers[value] = len(self.strings)
+            self.strings.append(value)
+        return number
+
+
+def compile_index(cache, path):
+    """Write a snapshot of cache (an apt.cache.Cache or compatible) to path."""
+    strings = StringTable()
+    packages = []
+    versions = []
+    origins = []
+    origin_numbers = {}
+    groups = []
+    deps = []
+    provides = []
+    rdeps = {}
+    providers = {}
+
+    for package in sorted(cache, key=lambda package: to_bytes(package.name)):
+        first_version = len(versions)
+        for version in package.versions:
+            first_origin = len(origins)
+            origin_list = []
+            for origin in version.origins:
+                record = (strings.add(origin.component), strings.add(origin.archive),
+                          strings.add(origin.site), strings.add(origin.origin),
+                          strings.add(get_archive_uri(version, origin)))
+                origin_list.append(record)
+
+            # Versions from the same archive share the same origin records.
+            key = tuple(origin_list)
+            if key in origin_numbers:
+                first_origin = origin_numbers[key]
+            else:
+                origin_numbers[key] = first_origin
+                origins.extend(origin_list)
+
+            first_group = len(groups)
+            for dependencies in version.dependencies:
+                groups.append((len(deps), len(dependencies)))
+                for dependency in dependencies:
+                    dep = (strings.add(dependency.name), strings.add(dependency.relation),
+                           strings.add(dependency.version))
+                    deps.append(dep)
+                    rdeps.setdefault(dependency.name, []).append(
+                        (strings.add(package.name), strings.add(version.version), dep[1], dep[2]))
+
+            first_provide = len(provides)
+            for name, provided_version in get_provides(version):
+                provides.append((strings.add(name), strings.add(provided_version)))
+                providers.setdefault(name, []).append(
+                    (strings.add(package.name), strings.add(version.version), provides[-1][1]))
+
+            source_name = getattr(version, 'source_name', None) or package.name
+            versions.append((strings.add(version.version), strings.add(source_name),
+                             strings.add(getattr(version, 'architecture', '')),
+                             first_origin, len(origin_list), first_group, len(groups) - first_group,
+                             first_provide, len(provides) - first_provide))
+
+        packages.append((strings.add(package.name), first_version, len(versions) - first_version))
+
+    targets = []
+    rdep_records = []
+    for name in sorted(rdeps, key=to_bytes):
+        targets.append((strings.add(name), len(rdep_records), len(rdeps[name])))
+        rdep_records.extend(rdeps[name])
+
+    provided = []
+    provider_records = []
+    for name in sorted(providers, key=to_bytes):
+        provided.append((strings.add(name), len(provider_records), len(providers[name])))
+        provider_records.extend(providers[name])
+
+    offsets = [0]
+    for value in strings.strings:
+        offsets.append(offsets[-1] + len(value))
+
+    sections = [
+        (len(strings.strings), b''.join(offset_struct.pack(offset) for offset in offsets) + b''.join(strings.strings)),
+        (len(packages), b''.join(package_struct.pack(*record) for record in packages)),
+        (len(versions), b''.join(version_struct.pack(*record) for record in versions)),
+        (len(origins), b''.join(origin_struct.pack(*record) for record in origins)),
+        (len(groups), b''.join(group_struct.pack(*record) for record in groups)),
+        (len(deps), b''.join(dep_struct.pack(*record) for record in deps)),
+        (len(provides), b''.join(provide_struct.pack(*record) for record in provides)),
+        (len(targets), b''.join(target_struct.pack(*record) for record in targets)),
+        (len(rdep_records), b''.join(rdep_struct.pack(*record) for record in rdep_records)),
+        (len(provided), b''.join(target_struct.pack(*record) for record in provided)),
+        (len(provider_records), b''.join(provider_struct.pack(*record) for record in provider_records)),
+    ]
+
+    header = [MAGIC, FORMAT]
+    position = header_struct.size
+    for count, data in sections:
+        # Keep every section 4-byte aligned.
+        position += -position % 4
+        header.extend([count, position])
+        position += len(data)
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as index_file:
+        index_file.write(header_struct.pack(*header))
+        for count, data in sections:
+            index_file.write(b'\0' * (-index_file.tell() % 4))
+            index_file.write(data)
+    os.rename(temporary_path, path)
+
+    return path
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""Query daemon keeping the repository caches of pkgver.py warm.
+
+The repositories are opened once, like pkgver.py does (snapshots,
+python-apt or --indexes), and queries are answered over HTTP on a TCP
+port or on a local Unix socket, each in its own thread. python-apt
+caches are compiled into snapshots as they are loaded, when theirs are
+missing or older than the apt lists, as pkgver.py -c does, and served
+from them, so queries run concurrently. Only with --no-index are they
+answered from python-apt, one at a time.
+
+    GET /closure?package=NAME[&version=V][&depth=N][&alternatives=1][&cycles=1]
+    GET /versions?package=NAME[&relation=R&version=V]
+    GET /rdepends?package=NAME[&version=V]
+    GET /requirements?name=REQUIREMENT
+    GET /status
+    POST /reload
+
+Every response is a JSON document. The last --memo-size closures are
+memoized until the next reload. A watcher thread compares the repository
+fingerprints (see resultcache.fingerprint) every --reload-interval
+seconds and reloads the caches in the background when they change, as
+does SIGHUP or POST /reload; queries keep being answered from the old
+caches meanwhile.
+
+    curl --unix-socket /run/pkg-tools.sock 'http://localhost/closure?package=nova-common'
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from urlparse import urlparse, parse_qs
+
+import debindex
+import debversion
+import get_build_packages
+import pkgindex
+import pkgver
+
+
+class Unavailable(Exception):
+
+    """Raised by queries needing something the server could not load"""
+
+
+class ServerState(object):
+
+    """Caches of one load of the repositories and their query results"""
+
+    def __init__(self, caches, fingerprints, memo_size):
+        self.caches = caches
+        self.fingerprints = fingerprints
+        # Shared by the handler threads; LRUCache locks itself.
+        self.results = debversion.LRUCache(memo_size)
+        self.accordance_index = None
+        self.loaded = time.time()
+        # python-apt caches (--no-index) are not safe to query from
+        # several threads; snapshots and parsed index files are, as is
+        # the version comparison memo of debversion.
+        if all(isinstance(cache, (pkgindex.PackageIndex, debindex.Deb822Cache)) for cache in caches.values()):
+            self.lock = None
+        else:
+            self.lock = threading.Lock()
+
+
+class QueryServer(object):
+
+    """Loads the repositories and answers the queries against them"""
+
+    def __init__(self, args):
+        self.args = args
+        self.distrs = []
+        for distr in [args.distr, 'mos'] + (args.extra_distr or []):
+            if distr not in self.distrs:
+                self.distrs.append(distr)
+
+        # Read on the first /requirements query, since it needs PyYAML.
+        self.accordance_path = os.path.abspath(args.accordance) if args.accordance else None
+        self.accordance_dictionary = None
+        self.accordance_lock = threading.Lock()
+
+        self.reload_lock = threading.Lock()
+        self.reloads = 0
+        self.state = self.load()
+        self.routes = {'/closure': self.closure, '/versions': self.versions, '/rdepends': self.rdepends,
+                       '/requirements': self.requirements, '/status': self.status}
+
+    def get_fingerprints(self):
+        packages = pkgver.TrustyPackages()
+        return dict((distr, packages.get_fingerprint(distr, indexes=self.args.indexes)) for distr in self.distrs)
+
+    def load(self):
+        fingerprints = self.get_fingerprints()
+        caches = pkgver.TrustyPackages().prepare_caches(self.distrs, self.args.jobs,
+                                                         use_index=not self.args.no_index,
+                                                         indexes=self.args.indexes)
+        return ServerState(caches, fingerprints, self.args.memo_size)
+
+    def reload(self):
+        """Load the repositories again and switch queries over to them.
+
+        Returns False when another reload is already running.
+        """
+        if not self.reload_lock.acquire(False):
+            return False
+        try:
+            started = time.time()
+            # Queries in flight keep the old state, which is dropped with
+            # its last reference.
+            self.state = self.load()
+            self.reloads += 1
+            print >> sys.stderr, 'Reloaded in %.2fs' % (time.time() - started)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+        finally:
+            self.reload_lock.release()
+        return True
+
+    def watch(self):
+        """Reload whenever the repository fingerprints change."""
+        while True:
+            time.sleep(self.args.reload_interval)
+            if self.get_fingerprints() != self.state.fingerprints:
+                self.reload()
+
+    def query(self, path, params):
+        """Answer the query of the route path, which must be in self.routes."""
+        handler = self.routes[path]
+        state = self.state
+        if state.lock is None:
+            return handler(state, params)
+        with state.lock:
+            return handler(state, params)
+
+    def closure(self, state, params):
+        package_name = get_param(params, 'package')
+        package_version = params.get('version') or None
+        depth = int(params['depth']) if params.get('depth') else None
+        all_alternatives = params.get('alternatives') == '1'
+        report_cycles = params.get('cycles') == '1'
+
+        key = ('closure', package_name, package_version, depth, all_alternatives, report_cycles)
+        try:
+            return state.results.get(key)
+        except KeyError:
+            pass
+
+        packages = pkgver.TrustyPackages(quiet=True, all_alternatives=all_alternatives)
+        packages.resolve_closure(state.caches[self.args.distr], package_name, package_version,
+                                 secondary_cache=state.caches['mos'], max_depth=depth,
+                                 report_cycles=report_cycles)
+        result = {'Name': package_name, 'Version': package_version or '',
+                  'Dependencies': pkgver.records_as_dicts(packages.pkg_dictionary),
+                  'Verified': pkgver.records_as_dicts(packages.verified_pkg_dictionary),
+                  'NotSatisfied': pkgver.records_as_dicts(packages.not_satisfied_pkg_dictionary),
+                  'Cycles': packages.cycles, 'Levels': packages.level_stats}
+        state.results.set(key, result)
+        return result
+
+    def versions(self, state, params):
+        package_name = get_param(params, 'package')
+        relation = params.get('relation', '')
+        version = params.get('version', '')
+        if bool(relation) != bool(version):
+            raise ValueError('relation and version go together')
+
+        packages = pkgver.TrustyPackages()
+        repositories = {}
+        for distr, cache in state.caches.items():
+            cell = packages.get_matrix_cell(cache, package_name, relation, version)
+            cell['Versions'] = [item.version for item in cache[package_name].versions] \
+                if package_name in cache else []
+            repositories[distr] = cell
+        return {'Name': package_name, 'Relation': relation, 'Version': version,
+                'Repositories': repositories}
+
+    def rdepends(self, state, params):
+        package_name = get_param(params, 'package')
+        new_version = params.get('version') or None
+        records = pkgver.TrustyPackages().get_reverse_dependencies(state.caches[self.args.distr],
+                                                                   package_name, new_version)
+        return {'Name': package_name, 'Version': new_version or '', 'ReverseDependencies': records}
+
+    def get_accordance_dictionary(self):
+        """Return the requirement to package name dictionary of -a, reading it on first use."""
+        with self.accordance_lock:
+            if self.accordance_dictionary is None:
+                dictionary = {}
+                if self.accordance_path:
+                    requirements = get_build_packages.TrustyPackages()
+                    try:
+                        requirements.load_accordance_dictionary(self.accordance_path)
+                    except (ImportError, IOError) as error:
+                        raise Unavailable('Cannot read %s: %s' % (self.accordance_path, error))
+                    dictionary = requirements.accordance_dictionary or {}
+                self.accordance_dictionary = dictionary
+            return self.accordance_dictionary
+
+    def requirements(self, state, params):
+        requirement = get_param(params, 'name')
+        cache = state.caches[self.args.distr]
+        # Built once per load of the repositories.
+        index = state.accordance_index
+        if index is None:
+            index = state.accordance_index = get_build_packages.AccordanceIndex(
+                self.get_accordance_dictionary(), cache)
+        package_name, match = index.lookup(requirement)
+        result = {'Requirement': requirement, 'Package': package_name, 'Match': match, 'Versions': []}
+        if package_name is None:
+            result['Suggestions'] = index.suggest(requirement)
+        if package_name and package_name in cache:
+            result['Versions'] = [{'Version': version.version, 'Uri': pkgindex.get_archive_uri(version)}
+                                  for version in cache[package_name].versions]
+        return result
+
+    def status(self, state, params):
+        return {'Repositories': dict((distr, {'Packages': len(cache), 'Fingerprint': state.fingerprints[distr]})
+                                     for distr, cache in state.caches.items()),
+                'Loaded': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(state.loaded)),
+                'Reloads': self.reloads, 'Memoized': len(state.results)}
+
+
+def get_param(params, name):
+    if not params.get(name):
+        raise ValueError('Missing parameter: %s' % name)
+    return params[name]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    """HTTP front end of QueryServer"""
+    server_version = 'pkg-tools/1.0'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        if url.path not in self.server.query_server.routes:
+            return self.send_json(404, {'Error': 'Unknown query: %s' % url.path})
+        try:
+            result = self.server.query_server.query(url.path, params)
+        except ValueError as error:
+            return self.send_json(400, {'Error': str(error)})
+        except Unavailable as error:
+            return self.send_json(503, {'Error': str(error)})
+        except Exception as error:
+            traceback.print_exc()
+            return self.send_json(500, {'Error': '%s: %s' % (type(error).__name__, error)})
+        self.send_json(200, result)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/reload':
+            return self.send_json(404, {'Error': 'Unknown request: %s' % self.path})
+        thread = threading.Thread(target=self.server.query_server.reload)
+        thread.daemon = True
+        thread.start()
+        self.send_json(202, {'Reloading': True})
+
+    def send_json(self, status, body):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.query_server.args.debug:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def main(args):
+    # pkgver reads its command line arguments from a module global.
+    pkgver.args = args
+    query_server = QueryServer(args)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, QueryHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+        address = 'http://%s:%d/' % (args.host, args.port)
+    server.query_server = query_server
+
+    def reload_on_signal(signum, frame):
+        thread = threading.Thread(target=query_server.reload)
+        thread.daemon = True
+        thread.start()
+    signal.signal(signal.SIGHUP, reload_on_signal)
+
+    if args.reload_interval:
+        watcher = threading.Thread(target=query_server.watch)
+        watcher.daemon = True
+        watcher.start()
+
+    print >> sys.stderr, 'Serving %s on %s' % (', '.join(query_server.distrs), address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer pkgver.py queries from warm caches.')
+    parser.add_argument('-s', '--socket', metavar=('PATH'), type=str,
+                        help='Listen on a Unix socket instead of TCP')
+    parser.add_argument('-H', '--host', metavar=('HOST'), type=str, default='127.0.0.1',
+                        help='TCP address to listen on')
+    parser.add_argument('-p', '--port', metavar=('PORT'), type=int, default=8642,
+                        help='TCP port to listen on')
+    parser.add_argument('-m', '--distr', metavar=('DISTR'), type=str, default='debian',
+                        help='Distribution closures are resolved in')
+    parser.add_argument('-x', '--extra-distr', nargs='+', metavar=('DISTR'), type=str,
+                        help='Additional distributions to load')
+    parser.add_argument('-I', '--indexes', metavar=('DIR'), type=str,
+                        help='Read Packages/Sources files from DIR/DISTR (or DIR) instead of python-apt')
+    parser.add_argument('-n', '--no-index', action='store_true',
+                        help='Ignore package index snapshots and answer from python-apt, one query at a time')
+    parser.add_argument('-a', '--accordance', metavar=('FILE'), type=str,
+                        help='Requirement to package name dictionary (YAML, read on the first '
+                             '/requirements query); without it requirements are only matched '
+                             'against the repository package names')
+    parser.add_argument('-r', '--reload-interval', metavar=('SECONDS'), type=int, default=60,
+                        help='Check the repositories for changes every SECONDS (0 disables)')
+    parser.add_argument('-M', '--memo-size', metavar=('RESULTS'), type=int, default=1024,
+                        help='Number of closure results kept between reloads')
+    parser.add_argument('-j', '--jobs', metavar=('JOBS'), type=int,
+                        help='Number of worker processes used while loading')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    main(args)
@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 
-import apt
 import argparse
+import debindex
+import debversion
+import hashlib
+import instrument
+import json
 import os
+import pkgindex
 import re
-import requests
+import resultcache
 import sys
-import yaml
+import time
+from collections import deque
 from cStringIO import StringIO
 from subprocess import Popen, PIPE
 
@@ -33,13 +39,107 @@ package_version_group = re.compile('^(?:\()?(?P<version_relation>>>|<<|>=|<=|==)
                                    '(?P<package_version>[a-z0-9-.:]+)')
 package_version_epoch_re = re.compile('^[0-9]+:')
 in_section = re.compile('^\s')
+sources_line_re = re.compile('^(?P<type>deb|deb-src)\s+(\[[^\]]*\]\s+)?'
+                             '(?P<uri>\S+)\s+(?P<suite>\S+)')
+index_file_name = 'pkgindex.bin'
+release_state_file_name = 'release-state.json'
+# Bump when the stored closure results change shape.
+result_format = 1
+
+
+def import_apt():
+    """Import python-apt, or return None when it is not installed.
+
+    python-apt, requests and yaml take longer to import than most runs
+    take to answer from a snapshot, so they are only imported by the code
+    paths needing them.
+    """
+    try:
+        import apt
+    except ImportError:
+        # Snapshots and index files (--indexes) are read without python-apt.
+        return None
+    return apt
+
+
+def require_apt():
+    """Return python-apt, aborting when it is not installed."""
+    apt = import_apt()
+    if apt is None:
+        print >> sys.stderr, 'python-apt is not installed; use a compiled snapshot or --indexes. Aborting.'
+        sys.exit(2)
+    return apt
+
+
+def is_snapshot_current(path_to_index, index_files):
+    """Tell whether the snapshot path_to_index is newer than every index file."""
+    return bool(index_files) and os.path.exists(path_to_index) and \
+        os.path.getmtime(path_to_index) >= max(os.path.getmtime(path) for path in index_files)
+
+
+def intern_string(value):
+    """Intern value so records of the same package share one string."""
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+class DependencyRecord(object):
+
+    """Dependency in the closure (an entry of pkg_dictionary)"""
+    __slots__ = ('name', 'relation', 'version', 'required_by')
+
+    def __init__(self, name, relation, version, required_by):
+        self.name = intern_string(name)
+        self.relation = intern_string(relation)
+        self.version = intern_string(version)
+        self.required_by = intern_string(required_by)
+
+    def as_dict(self):
+        return {'Name': self.name, 'Relation': self.relation, 'Version': self.version,
+                'PKG_WHICH_REQUIRES': self.required_by}
+
+
+class VerifiedRecord(object):
+
+    """Package found in the primary cache (an entry of verified_pkg_dictionary)"""
+    __slots__ = ('name', 'source_name')
+
+    def __init__(self, name, source_name):
+        self.name = intern_string(name)
+        self.source_name = intern_string(source_name)
+
+    def as_dict(self):
+        return {'Name': self.name, 'SourceName': self.source_name}
+
+
+class UnsatisfiedRecord(object):
+
+    """Dependency the secondary cache does not satisfy
+    (an entry of not_satisfied_pkg_dictionary)"""
+    __slots__ = ('name', 'relation', 'version', 'required_by', 'absent')
+
+    def __init__(self, dependency, absent):
+        self.name = dependency.name
+        self.relation = dependency.relation
+        self.version = dependency.version
+        self.required_by = dependency.required_by
+        self.absent = absent
+
+    def as_dict(self):
+        return {'Name': self.name, 'Relation': self.relation, 'Version': self.version,
+                'PKG_WHICH_REQUIRES': self.required_by, 'NA': str(self.absent)}
+
+
+def records_as_dicts(records):
+    return [record.as_dict() for record in records]
 
 
 class TrustyPackages:
 
     """Package processing
     """
-    def __init__(self):
+    def __init__(self, memo=None, quiet=False, all_alternatives=False):
         """Docstring"""
         self.package_dic = {}
         self.requirements_doc = {}
@@ -50,6 +150,15 @@ class TrustyPackages:
         self.pkg_dictionary = []
         self.verified_pkg_dictionary = []
         self.not_satisfied_pkg_dictionary = []
+        self.pkg_index = {}
+        self.verified_names = set()
+        self.memo = memo if memo is not None else {}
+        self.quiet = quiet
+        # Expand every or-group alternative and ignore Provides.
+        self.all_alternatives = all_alternatives
+        # Called with (record type, record) for every result as it is found.
+        self.record_sink = None
+        self.keep_records = True
 
     def get_packages(self, line):
         """Docstring"""
@@ -131,6 +240,8 @@ class TrustyPackages:
 
     def load_accordance_dictionary(self, dict_file):
         """Docstring."""
+        import yaml
+        from yaml.scanner import ScannerError
         with open(dict_file, 'r') as dict_yaml:
             try:
                 self.accordance_dictionary = yaml.safe_load(dict_yaml)
@@ -152,7 +263,20 @@ class TrustyPackages:
                     self.requirements_doc[name] = version
 
     def prepare_cache(self, path_to_cache, version):
+        apt = require_apt()
         cache = apt.cache.Cache(rootdir=path_to_cache)
+        self.prepare_sources_list(path_to_cache, version)
+
+        cache.clear()
+        with instrument.phase('cache update'):
+            cache.update()
+        with instrument.phase('cache open'):
+            cache.open()
+
+        return cache
+
+    def prepare_sources_list(self, path_to_cache, version):
+        """Fill an empty sources.list with the default repositories."""
         path_to_sources_list = os.path.join(path_to_cache, 'etc/apt/sources.list')
         if os.path.exists(path_to_sources_list) and os.stat(path_to_sources_list).st_size == 0:
             if version == 'debian':
@@ -199,33 +323,321 @@ deb http://perestroika-repo-tst.infra.mirantis.net/mos-repos/ubuntu/master/ mos-
                 file.write(sources)
                 file.close()
 
-        cache.clear()
-        cache.update()
-        cache.open()
+    def get_sources(self, path_to_cache):
+        """Group sources.list lines by (uri, suite)."""
+        sources = {}
+        path_to_sources_list = os.path.join(path_to_cache, 'etc/apt/sources.list')
+        if not os.path.exists(path_to_sources_list):
+            return sources
+
+        with open(path_to_sources_list, 'r') as sources_list:
+            for line in sources_list:
+                match = sources_line_re.match(line)
+                if match:
+                    sources.setdefault((match.group('uri'), match.group('suite')), []).append(line)
+
+        return sources
+
+    def check_release(self, uri, suite, known):
+        """Compare the Release file of a source with the last fetch.
+
+        Returns a (status, state) pair, status being one of 'fresh',
+        'changed', 'new' or 'unreachable'. Local (file://) mirrors are
+        only read when their mtime moved; remote ones are asked with
+        If-None-Match/If-Modified-Since.
+        """
+        if suite.endswith('/'):
+            base_url = uri.rstrip('/') + '/' + suite
+        else:
+            base_url = uri.rstrip('/') + '/dists/' + suite + '/'
+
+        for url in [base_url + 'InRelease', base_url + 'Release']:
+            state = {'URL': url, 'Checked': time.time()}
+            same_url = known and known.get('URL') == url
+
+            if url.startswith('file://'):
+                path = url[len('file://'):]
+                if not os.path.exists(path):
+                    continue
+                state['Modified'] = str(os.stat(path).st_mtime)
+                if same_url and known.get('Modified') == state['Modified']:
+                    state.update({'Hash': known['Hash'], 'Changed': known['Changed']})
+                    return 'fresh', state
+                with open(path, 'rb') as release:
+                    content = release.read()
+            else:
+                headers = {}
+                if same_url and known.get('ETag'):
+                    headers['If-None-Match'] = known['ETag']
+                if same_url and known.get('Modified'):
+                    headers['If-Modified-Since'] = known['Modified']
+                import requests
+                try:
+                    response = requests.get(url, headers=headers, timeout=30)
+                except requests.RequestException:
+                    continue
+                if response.status_code == 304:
+                    state.update({'Hash': known['Hash'], 'Changed': known['Changed'],
+                                  'ETag': known.get('ETag'), 'Modified': known.get('Modified')})
+                    return 'fresh', state
+                if response.status_code != 200:
+                    continue
+                state['ETag'] = response.headers.get('ETag')
+                state['Modified'] = response.headers.get('Last-Modified')
+                content = response.content
+
+            state['Hash'] = hashlib.sha256(content).hexdigest()
+            if not known:
+                state['Changed'] = state['Checked']
+                return 'new', state
+            if known.get('Hash') == state['Hash']:
+                state['Changed'] = known['Changed']
+                return 'fresh', state
+            state['Changed'] = state['Checked']
+            return 'changed', state
+
+        return 'unreachable', known
+
+    def check_sources(self, path_to_cache, version):
+        """Report per-source freshness of the cache of version.
+
+        Returns the sources.list lines that need fetching and the release
+        state to store once they have been fetched.
+        """
+        path_to_state = os.path.join(path_to_cache, release_state_file_name)
+        if os.path.exists(path_to_state):
+            with open(path_to_state, 'r') as state_file:
+                known_state = json.load(state_file)
+        else:
+            known_state = {}
+
+        changed_lines = []
+        release_state = {}
+        for (uri, suite), lines in sorted(self.get_sources(path_to_cache).items()):
+            key = uri + ' ' + suite
+            status, state = self.check_release(uri, suite, known_state.get(key))
+            if state:
+                release_state[key] = state
+                changed = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['Changed']))
+                print >> sys.stderr, '[%s] %s %s: %s (last changed %s)' % (version, uri, suite, status, changed)
+            else:
+                print >> sys.stderr, '[%s] %s %s: %s' % (version, uri, suite, status)
+            if status in ['changed', 'new']:
+                changed_lines.extend(lines)
+
+        return changed_lines, release_state
+
+    def refresh_cache(self, cache, path_to_cache, changed_lines):
+        """Fetch only the given sources.list lines and reopen the cache."""
+        path_to_changed = os.path.join(path_to_cache, 'etc/apt/sources.list.changed')
+        with open(path_to_changed, 'w') as changed:
+            changed.write(''.join(changed_lines))
+
+        apt = require_apt()
+        # Lists of the sources left out of this update must survive it.
+        apt.apt_pkg.config.set('APT::Get::List-Cleanup', 'false')
+        apt.apt_pkg.config.set('APT::List-Cleanup', 'false')
+        with instrument.phase('cache update'):
+            cache.update(sources_list=path_to_changed)
+        with instrument.phase('cache open'):
+            cache.open()
+        os.remove(path_to_changed)
 
         return cache
 
-    def prepare_apt(self, version, update_cache=False, cache_path='cache'):
+    def prepare_apt(self, version, update_cache=False, cache_path='cache', use_index=True, compile_index=False,
+                    refresh=False, indexes=None, index_jobs=None):
+        """Open the cache of version.
+
+        A snapshot compiled into the cache directory is used instead of
+        python-apt unless the cache is being updated or recompiled. With
+        refresh only the sources whose Release file changed are fetched.
+        With indexes the cache is read from downloaded index files instead
+        of python-apt; see prepare_indexes.
+        """
         try:
             current_dir = os.getcwd()
         except:
             current_dir = './'
 
         path_to_cache = os.path.join(current_dir, cache_path, version)
+        path_to_index = os.path.join(path_to_cache, index_file_name)
+        changed_lines = []
 
+        if indexes:
+            return self.prepare_indexes(version, indexes, path_to_index, use_index, compile_index, index_jobs)
+
+        if refresh and not update_cache:
+            self.prepare_sources_list(path_to_cache, version)
+            with instrument.phase('release check'):
+                changed_lines, release_state = self.check_sources(path_to_cache, version)
+
+        if use_index and not update_cache and not compile_index and not changed_lines \
+           and os.path.exists(path_to_index):
+            try:
+                with instrument.phase('snapshot open'):
+                    return pkgindex.PackageIndex(path_to_index)
+            except ValueError:
+                # Written by an older format; rebuild it from python-apt.
+                compile_index = True
+
+        apt = require_apt()
+
+        updated = update_cache
         if update_cache:
             cache = self.prepare_cache(path_to_cache, version)
+        elif changed_lines:
+            with instrument.phase('cache open'):
+                cache = apt.cache.Cache(rootdir=path_to_cache)
+            if len(cache) == 0:
+                cache = self.prepare_cache(path_to_cache, version)
+            else:
+                cache = self.refresh_cache(cache, path_to_cache, changed_lines)
+            updated = True
         else:
-            cache = apt.cache.Cache(rootdir=path_to_cache)
+            with instrument.phase('cache open'):
+                cache = apt.cache.Cache(rootdir=path_to_cache)
             if len(cache) == 0:
                 cache = self.prepare_cache(path_to_cache, version)
+                updated = True
 
                 if len(cache) == 0:
                     print('Cache is still empty after update. Check sources list. Aborting.')
                     sys.exit(2)
 
+        if refresh and not update_cache:
+            with open(os.path.join(path_to_cache, release_state_file_name), 'w') as state_file:
+                json.dump(release_state, state_file, indent=2, sort_keys=True)
+
+        # A snapshot left from an earlier run is stale after an update.
+        if compile_index or (updated and os.path.exists(path_to_index)):
+            with instrument.phase('snapshot compile'):
+                pkgindex.compile_index(cache, path_to_index)
+            if use_index:
+                # Queried like the python-apt cache, but from any thread.
+                cache.close()
+                with instrument.phase('snapshot open'):
+                    return pkgindex.PackageIndex(path_to_index)
+
         return cache
 
+    def get_fingerprint(self, version, cache_path='cache', indexes=None):
+        """Fingerprint of the repository indexes of version; see resultcache.fingerprint."""
+        if indexes:
+            directory = os.path.join(indexes, version)
+            if not os.path.isdir(directory):
+                directory = indexes
+        else:
+            directory = os.path.join(os.getcwd(), cache_path, version, 'var/lib/apt/lists')
+        return resultcache.fingerprint(directory)
+
+    def get_indexes_path(self, version, indexes):
+        """Return indexes/version, or indexes itself when it has no such subdirectory."""
+        path_to_indexes = os.path.join(indexes, version)
+        if not os.path.isdir(path_to_indexes):
+            path_to_indexes = indexes
+        return path_to_indexes
+
+    def has_current_snapshot(self, version, cache_path='cache', indexes=None):
+        """Tell whether the snapshot of version is newer than its index
+        files, or than the apt lists of its cache."""
+        path_to_index = os.path.join(cache_path, version, index_file_name)
+        if indexes:
+            return is_snapshot_current(path_to_index,
+                                       debindex.find_index_files(self.get_indexes_path(version, indexes)))
+
+        path_to_lists = os.path.join(cache_path, version, 'var/lib/apt/lists')
+        lists = [os.path.join(path_to_lists, name) for name in os.listdir(path_to_lists)] \
+            if os.path.isdir(path_to_lists) else []
+        # A snapshot without lists next to it was copied in; it is all there is.
+        return os.path.exists(path_to_index) and (not lists or is_snapshot_current(path_to_index, lists))
+
+    def prepare_indexes(self, version, indexes, path_to_index, use_index=True, compile_index=False, jobs=None):
+        """Open version from the Packages/Sources files in indexes/version,
+        or in indexes itself when it has no such subdirectory.
+
+        The snapshot at path_to_index is used while it is newer than every
+        index file.
+        """
+        path_to_indexes = self.get_indexes_path(version, indexes)
+        index_files = debindex.find_index_files(path_to_indexes)
+        if not index_files:
+            print >> sys.stderr, 'No Packages or Sources files in %s. Aborting.' % path_to_indexes
+            sys.exit(2)
+
+        if use_index and not compile_index and is_snapshot_current(path_to_index, index_files):
+            try:
+                with instrument.phase('snapshot open'):
+                    return pkgindex.PackageIndex(path_to_index)
+            except ValueError:
+                compile_index = True
+
+        with instrument.phase('index files load'):
+            cache = debindex.load_index_files(index_files, jobs)
+        instrument.count('index files read', len(index_files))
+        if compile_index:
+            if not os.path.isdir(os.path.dirname(path_to_index)):
+                os.makedirs(os.path.dirname(path_to_index))
+            with instrument.phase('snapshot compile'):
+                pkgindex.compile_index(cache, path_to_index)
+
+        return cache
+
+    def prepare_caches(self, versions, jobs=None, update_cache=False, use_index=True, compile_index=False, refresh=False,
+                       indexes=None):
+        """Prepare the caches of versions, returning a version -> cache dict.
+
+        The caches without a current snapshot, or all of them with
+        update_cache, compile_index or refresh, are prepared concurrently
+        in worker processes (python-apt keeps its configuration global, so
+        caches with different roots cannot be built side by side in
+        threads). Each worker updates and opens its cache and compiles it
+        into a snapshot, which is then opened here in milliseconds, so
+        startup takes as long as the slowest cache. With a single job they
+        are compiled here. Without use_index the workers only update; the
+        python-apt caches are then opened here one after another.
+        """
+        workers = jobs or len(versions)
+        if update_cache or compile_index or refresh:
+            pending = list(versions)
+        elif use_index:
+            pending = [version for version in versions if not self.has_current_snapshot(version, indexes=indexes)]
+        else:
+            pending = []
+
+        if len(pending) > 1 and workers > 1:
+            # Pool workers cannot start pools of their own, so index files
+            # are parsed sequentially inside them.
+            options = {'update_cache': update_cache, 'use_index': use_index,
+                       'compile_index': compile_index or use_index, 'refresh': refresh,
+                       'indexes': indexes, 'index_jobs': 1}
+            import multiprocessing
+            pool = multiprocessing.Pool(min(workers, len(pending)))
+            try:
+                results = pool.map(prepare_cache_worker, [(version, options) for version in pending])
+            finally:
+                pool.close()
+                pool.join()
+
+            for version, status, elapsed, size in results:
+                if status:
+                    print >> sys.stderr, '[%s] failed after %.2fs' % (version, elapsed)
+                    sys.exit(status)
+                print >> sys.stderr, '[%s] prepared in %.2fs (%d packages)' % (version, elapsed, size)
+            update_cache = compile_index = refresh = False
+            pending = []
+
+        caches = {}
+        for version in versions:
+            started = time.time()
+            caches[version] = self.prepare_apt(version, update_cache, use_index=use_index,
+                                               compile_index=compile_index or (use_index and version in pending),
+                                               refresh=refresh,
+                                               indexes=indexes, index_jobs=jobs)
+            print >> sys.stderr, '[%s] opened in %.2fs (%d packages)' % (version, time.time() - started, len(caches[version]))
+
+        return caches
+
     def get_absent_packages(self, package_name, repo_cache, debug=False):
         match = pkg_recommended_re.match(package_name)
         if match:
@@ -235,117 +647,457 @@ deb http://perestroika-repo-tst.infra.mirantis.net/mos-repos/ubuntu/master/ mos-
                 cur_pkg = repo_cache[pkg_name]
 
                 if pkg_version:
-                    valid_marker = False
-                    for version in cur_pkg.versions:
-                        #print version.version
-                        compared_versions = apt.apt_pkg.version_compare(pkg_version, version.version)
-                        if args.debug:
-                            print pkg_version + ' <> ' + version.version
-                            print compared_versions
-                        if compared_versions < 0:
-                            valid_marker = True
-
-                    if not valid_marker:  
+                    versions = debversion.VersionList([version.version for version in cur_pkg.versions])
+                    newer_versions = versions.satisfying('>>', pkg_version)
+                    if args.debug:
+                        print pkg_version + ' << ' + ', '.join(newer_versions)
+
+                    if not newer_versions:
                         print pkg_name + ' [ ' + pkg_version + ' ] ' + ' --- is absent.'
             except KeyError:
                 print pkg_name + ' --- is absent.'
 
 
 
-    def get_package_from_cache(self, repo_cache, package_name, package_version=None, secondary_cache=None):
-        
-        if args.debug:
-            print 'Verifying: ' + package_name
-        for package in repo_cache.keys():
-            already_in_the_list = False
-            if package == package_name:
-
-                cur_pkg = repo_cache[package]
-                if len(cur_pkg.versions) > 1:
-                    print '========================='
-                    print 'More than one version of package: ' + package
-                    print '========================='
-                    for version in cur_pkg.versions:
-                        package_origin = version.origins.pop()
-                        print ('%s - [%s|%s|%s|%s]' % (version.version, package_origin.component, package_origin.archive, package_origin.site, package_origin.origin))
-                    print '========================='
-                else:
-                    package_origin = cur_pkg.versions[0]
-
-                if hasattr(package_origin, 'source_name'):
-                    package_source_name = package_origin.source_name
-                else:
-                    package_source_name = package_name
-
-                for package_element in self.verified_pkg_dictionary:
-                    if  package_element['Name'] == package_name:
-                        already_in_the_list = True
-
-                if not already_in_the_list:
-                    self.verified_pkg_dictionary.append({'Name' : package_name, 'SourceName': package_source_name})
-
+    def expand_package(self, repo_cache, package_name, package_version=None):
+        """Return the source name and dependency triples of package_name.
+
+        The or-groups read from the cache are kept in self.memo, which may
+        be shared between several TrustyPackages instances resolving
+        closures over the same cache; the alternative of each group is
+        chosen for this closure.
+        """
+        key = ('expand', id(repo_cache), package_name, package_version)
+        if key not in self.memo:
+            self.memo[key] = self.read_dependencies(repo_cache, package_name, package_version)
+        package_source_name, groups = self.memo[key]
+
+        dependency_list = []
+        for alternatives in groups:
+            if self.all_alternatives:
+                dependency_list.extend(alternatives)
+            else:
+                dependency_list.extend(self.choose_alternative(repo_cache, alternatives))
+
+        return package_source_name, dependency_list
+
+    def read_dependencies(self, repo_cache, package_name, package_version=None):
+        """Return the source name and dependency or-groups of package_name."""
+        instrument.count('packages expanded')
+        instrument.count('cache lookups')
+        cur_pkg = repo_cache[package_name]
+        if len(cur_pkg.versions) > 1:
+            package_origin = None
+            if not self.quiet:
+                print '========================='
+                print 'More than one version of package: ' + package_name
+                print '========================='
                 for version in cur_pkg.versions:
-                    if package_version and version.version != package_version:
+                    package_origin = version.origins.pop()
+                    print ('%s - [%s|%s|%s|%s]' % (version.version, package_origin.component, package_origin.archive, package_origin.site, package_origin.origin))
+                print '========================='
+        else:
+            package_origin = cur_pkg.versions[0]
+
+        if hasattr(package_origin, 'source_name'):
+            package_source_name = package_origin.source_name
+        else:
+            package_source_name = package_name
+
+        groups = []
+        for version in cur_pkg.versions:
+            if package_version and version.version != package_version:
+                continue
+
+            for dependencies in version.dependencies:
+                alternatives = []
+                for dependency in dependencies:
+                    if not dependency.name:
                         continue
+                    if dependency.relation:
+                        alternatives.append((intern_string(dependency.name), intern_string(dependency.relation),
+                                             intern_string(dependency.version)))
+                    else:
+                        alternatives.append((intern_string(dependency.name), '', ''))
+                groups.append(alternatives)
+
+        return package_source_name, groups
+
+    def get_version_list(self, repo_cache, package_name):
+        """Return the sorted VersionList of package_name in repo_cache."""
+        key = ('versions', id(repo_cache), package_name)
+        if key not in self.memo:
+            instrument.count('cache lookups')
+            self.memo[key] = debversion.VersionList([version.version for version in repo_cache[package_name].versions])
+
+        return self.memo[key]
+
+    def choose_alternative(self, repo_cache, alternatives):
+        """Reduce an or-group to the alternative apt would pick.
+
+        That is the first alternative satisfiable by a real package or by
+        a package providing it; a provider replaces the virtual name. Of
+        several providers the one already in the closure is taken, else
+        the first by name, whatever order the backend lists them in. When
+        nothing is satisfiable the first alternative is kept, so that it
+        is reported.
+        """
+        for name, relation, version in alternatives:
+            if name in repo_cache:
+                if not relation or self.get_version_list(repo_cache, name).satisfying(relation, version):
+                    return [(name, relation, version)]
+
+            # Only versioned Provides satisfy versioned dependencies.
+            providers = sorted(set(provider for provider, provider_version, provided_version
+                                   in self.get_providers(repo_cache, name)
+                                   if not relation or (provided_version and
+                                                       debversion.satisfies(provided_version, relation, version))))
+            if providers:
+                for provider in providers:
+                    if provider in self.pkg_index:
+                        return [(intern_string(provider), '', '')]
+                return [(intern_string(providers[0]), '', '')]
+
+        return alternatives[:1]
+
+    def get_providers(self, repo_cache, package_name):
+        """Return the (provider, provider version, provided version) tuples
+        of package_name in repo_cache."""
+        return pkgindex.get_providers(repo_cache, package_name)
+
+    def add_record(self, records, record_type, record):
+        """Store a result record and pass it on to record_sink."""
+        instrument.count('%s records' % record_type)
+        if self.keep_records:
+            records.append(record)
+        if self.record_sink is not None:
+            self.record_sink(record_type, record)
+
+    def get_secondary_version(self, secondary_cache, package_name):
+        """Return the first version of package_name in secondary_cache, or None."""
+        key = ('secondary', id(secondary_cache), package_name)
+        if key not in self.memo:
+            if package_name in secondary_cache:
+                self.memo[key] = secondary_cache[package_name].versions[0].version
+            else:
+                self.memo[key] = None
+
+        return self.memo[key]
+
+    def get_package_from_cache(self, repo_cache, package_name, package_version=None, secondary_cache=None, expand=True):
+        """Expand package_name one level and check it against secondary_cache.
+
+        Lookups go through name-keyed indexes (pkg_index, verified_names)
+        instead of scanning the cache keys and the result lists.
+        Returns the names of the dependencies seen while expanding.
+        """
+        edges = []
+        if args.debug:
+            print >> sys.stderr, 'Verifying: ' + package_name
+
+        if expand and package_name in repo_cache:
+            package_source_name, dependencies = self.expand_package(repo_cache, package_name, package_version)
+
+            if package_name not in self.verified_names:
+                self.verified_names.add(package_name)
+                self.add_record(self.verified_pkg_dictionary, 'verified', VerifiedRecord(package_name, package_source_name))
 
-                    for dependencies in version.dependencies:
-                        for dependency in dependencies:
-                            if dependency.name:
-                                already_in_the_list = False
-
-                                if len(self.pkg_dictionary) > 0:
-                                    for package_element in self.pkg_dictionary:
-                                        if  package_element['Name'] == dependency.name:
-                                            already_in_the_list = True
-
-                                if not already_in_the_list:
-                                    if dependency.relation:
-                                        self.pkg_dictionary.append({'Name' : dependency.name, 'Relation' : dependency.relation, 'Version' : dependency.version, 'PKG_WHICH_REQUIRES': package_name})
-                                    else:
-                                        self.pkg_dictionary.append({'Name' : dependency.name, 'Relation' : '', 'Version' : '', 'PKG_WHICH_REQUIRES': package_name})
-
-                                if already_in_the_list:
-                                    if dependency.relation:
-                                        update_dic = False
-                                        package_in_dic = [d for d in self.pkg_dictionary if d['Name'] == dependency.name]
-                                        package_in_dic = package_in_dic.pop()
-                                        diff_result = apt.apt_pkg.version_compare(package_in_dic['Relation']+package_in_dic['Version'],dependency.relation+dependency.version)
-                                        if diff_result < -1 or diff_result == 1:
-                                            update_dic = True
-                                        elif diff_result == 0 or diff_result > 1 or diff_result == -1:
-                                            pass
-                                        else:
-                                            import ipdb; ipdb.set_trace()
-
-                                        if update_dic:
-                                            for dic in self.pkg_dictionary:
-                                                if dic['Name'] == dependency.name:
-                                                    dic_2_update = {'Name' : dependency.name, 'Relation' : dependency.relation, 'Version' : dependency.version, 'PKG_WHICH_REQUIRES': package_name}
-                                                    dic.update(dic_2_update)
+            for name, relation, version in dependencies:
+                edges.append(name)
 
+                package_in_dic = self.pkg_index.get(name)
+
+                if package_in_dic is None:
+                    package_in_dic = DependencyRecord(name, relation, version, package_name)
+                    self.pkg_index[name] = package_in_dic
+                    self.pkg_dictionary.append(package_in_dic)
+                    instrument.count('resolved records')
+                    if self.record_sink is not None:
+                        self.record_sink('resolved', package_in_dic)
+
+                elif relation:
+                    diff_result = debversion.version_compare(package_in_dic.relation+package_in_dic.version,relation+version)
+                    if diff_result < -1 or diff_result == 1:
+                        package_in_dic.relation = relation
+                        package_in_dic.version = version
+                        package_in_dic.required_by = intern_string(package_name)
+                        if self.record_sink is not None:
+                            self.record_sink('updated', package_in_dic)
 
         if secondary_cache:
-            package_found = False
-            for package in secondary_cache.keys():
-                if package == package_name:
-                    package_found = True
-                    cur_pkg = secondary_cache[package]
+            package_in_dic = self.pkg_index[package_name]
+            secondary_version = self.get_secondary_version(secondary_cache, package_name)
+
+            if secondary_version is not None:
+                diff_result = debversion.version_compare(package_in_dic.version,secondary_version)
+
+                if diff_result == 1:
+                    self.add_record(self.not_satisfied_pkg_dictionary, 'unsatisfied', UnsatisfiedRecord(package_in_dic, False))
+            elif self.all_alternatives or not self.get_providers(secondary_cache, package_name):
+                self.add_record(self.not_satisfied_pkg_dictionary, 'unsatisfied', UnsatisfiedRecord(package_in_dic, True))
+
+        return edges
+
+    def get_matrix_cell(self, repo_cache, package_name, relation='', version=''):
+        """Best version of package_name in repo_cache for (relation, version).
+
+        Returns a {'Version', 'Status'} dict; Status is 'satisfied',
+        'unsatisfied' (the newest version is given), 'provided' (by the
+        package in 'Provider') or 'absent'.
+        """
+        if package_name in repo_cache:
+            versions = self.get_version_list(repo_cache, package_name)
+            matching = versions.satisfying(relation, version)
+            if matching:
+                return {'Version': matching[-1], 'Status': 'satisfied'}
+            return {'Version': versions.newest(), 'Status': 'unsatisfied'}
+
+        for provider, provider_version, provided_version in self.get_providers(repo_cache, package_name):
+            if not relation or (provided_version and debversion.satisfies(provided_version, relation, version)):
+                return {'Version': provider_version, 'Status': 'provided', 'Provider': provider}
+
+        return {'Version': '', 'Status': 'absent'}
+
+    def get_version_matrix(self, caches, repositories, package_name, package_version=None):
+        """Check the resolved closure of package_name against repositories.
+
+        Returns one row per package: its name, the constraint the closure
+        puts on it and a repository -> get_matrix_cell dict.
+        """
+        constraints = [(package_name, '=' if package_version else '', package_version or '')]
+        constraints.extend((record.name, record.relation, record.version) for record in self.pkg_dictionary)
+
+        rows = []
+        for name, relation, version in constraints:
+            cells = dict((repository, self.get_matrix_cell(caches[repository], name, relation, version))
+                         for repository in repositories)
+            rows.append({'Name': name, 'Relation': relation, 'Version': version, 'Repositories': cells})
+
+        return rows
+
+    def get_reverse_dependencies(self, repo_cache, package_name, new_version=None):
+        """Return a record for every package version depending on package_name.
+
+        With new_version each record tells whether that version would
+        still satisfy the dependent's constraint.
+        """
+        records = []
+        reverse_index = pkgindex.get_dependency_index(repo_cache)
+        for dependent, dependent_version, relation, version in reverse_index.reverse_dependencies(package_name):
+            record = {'Name': dependent, 'DependentVersion': dependent_version,
+                      'Relation': relation, 'Version': version}
+            if new_version:
+                record['Satisfied'] = debversion.satisfies(new_version, relation, version)
+            records.append(record)
+
+        return records
+
+    def resolve_closure(self, repo_cache, package_name, package_version=None, secondary_cache=None, max_depth=None, report_cycles=False):
+        """Breadth-first dependency closure of package_name.
+
+        The root is expanded first; every dependency it pulls in is queued
+        once and checked against secondary_cache. Packages at max_depth are
+        checked but not expanded further. Per-level statistics end up in
+        level_stats, and dependency cycles in cycles if report_cycles is set.
+        """
+        self.level_stats = []
+        self.cycles = []
+        parents = {package_name: None}
+        worklist = deque([(package_name, 0)])
+
+        while worklist:
+            name, depth = worklist.popleft()
+            while len(self.level_stats) <= depth:
+                self.level_stats.append({'Level': len(self.level_stats), 'Expanded': 0, 'Edges': 0, 'Time': 0.0})
+            stats = self.level_stats[depth]
+            expand = max_depth is None or depth < max_depth
+            known = len(self.pkg_dictionary)
+            started = time.time()
+
+            if depth == 0:
+                edges = self.get_package_from_cache(repo_cache, name, package_version, expand=expand)
+            else:
+                edges = self.get_package_from_cache(repo_cache, name, secondary_cache=secondary_cache, expand=expand)
+
+            stats['Time'] += time.time() - started
+            stats['Edges'] += len(edges)
+            if expand:
+                stats['Expanded'] += 1
+
+            for package_in_dic in self.pkg_dictionary[known:]:
+                parents.setdefault(package_in_dic.name, name)
+                worklist.append((package_in_dic.name, depth + 1))
+
+            if report_cycles:
+                for dependency_name in edges:
+                    if parents.get(dependency_name) != name or dependency_name == name:
+                        self.report_cycle(parents, name, dependency_name)
+
+    def report_cycle(self, parents, package_name, dependency_name):
+        """Record package_name -> dependency_name if it closes a cycle."""
+        path = [package_name]
+        while path[-1] != dependency_name:
+            parent = parents.get(path[-1])
+            if parent is None:
+                return
+            path.append(parent)
+        path.reverse()
+        path.append(dependency_name)
+        if path not in self.cycles:
+            self.cycles.append(path)
+
+def prepare_cache_worker(task):
+    """Prepare one cache in a pool worker; see prepare_caches."""
+    version, options = task
+    started = time.time()
+    print >> sys.stderr, '[%s] preparing cache' % version
+    try:
+        cache = TrustyPackages().prepare_apt(version, **options)
+    except SystemExit as error:
+        return version, error.code or 1, time.time() - started, 0
+
+    size = len(cache)
+    cache.close()
+    return version, 0, time.time() - started, size
+
+def read_batch(batch_file):
+    """Yield (package name, version) pairs from batch_file ('-' for stdin)."""
+    if batch_file == '-':
+        batch = sys.stdin
+    else:
+        batch = open(batch_file, 'r')
+
+    try:
+        for line in batch:
+            words = line.split('#', 1)[0].split()
+            if words:
+                yield words[0], (words[1] if len(words) > 1 else None)
+    finally:
+        if batch is not sys.stdin:
+            batch.close()
+
+batch_state = {}
+
+def resolve_batch_entry(entry):
+    """Resolve one batch entry against the caches in batch_state.
 
-                    version = cur_pkg.versions[0]
+    Expanded packages, secondary lookups and whole closures are memoized
+    in batch_state['memo'], so the entries processed by one process
+    share every subtree they have in common.
+    """
+    package_name, package_version = entry
+    memo = batch_state['memo']
+    key = ('closure', package_name, package_version)
+
+    if key not in memo:
+        packages = TrustyPackages(memo=memo, quiet=not args.debug,
+                                  all_alternatives=batch_state['all_alternatives'])
+        packages.resolve_closure(batch_state['repo_cache'], package_name, package_version,
+                                 secondary_cache=batch_state['secondary_cache'],
+                                 max_depth=batch_state['max_depth'])
+        memo[key] = {'Dependencies': records_as_dicts(packages.pkg_dictionary),
+                     'Verified': records_as_dicts(packages.verified_pkg_dictionary),
+                     'NotSatisfied': records_as_dicts(packages.not_satisfied_pkg_dictionary)}
+
+    record = {'Name': package_name, 'Version': package_version or ''}
+    record.update(memo[key])
+    return record
+
+def resolve_batch(batch_file, repo_cache, secondary_cache, max_depth=None, jobs=None, all_alternatives=False):
+    """Yield one result record per entry of batch_file.
+
+    With jobs > 1 the entries are spread over a pool of forked workers,
+    which inherit the already opened caches.
+    """
+    batch_state.update({'repo_cache': repo_cache, 'secondary_cache': secondary_cache,
+                        'max_depth': max_depth, 'all_alternatives': all_alternatives, 'memo': {}})
+    entries = read_batch(batch_file)
+
+    if jobs and jobs > 1:
+        entries = list(entries)
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for record in pool.imap(resolve_batch_entry, entries, max(1, len(entries) // (jobs * 4))):
+                yield record
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for entry in entries:
+            yield resolve_batch_entry(entry)
+
+def write_ndjson(record_type, record, stream=sys.stdout):
+    """Write one record as a JSON line tagged with its type."""
+    if hasattr(record, 'as_dict'):
+        line = record.as_dict()
+    else:
+        line = dict(record)
+    line['Type'] = record_type
+    stream.write(json.dumps(line, sort_keys=True) + '\n')
+    stream.flush()
 
-                    if version:
-                        package_in_dic = [d for d in self.pkg_dictionary if d['Name'] == package_name]
-                        package_in_dic = package_in_dic.pop()
+def format_matrix(repositories, rows):
+    """Return the rows of get_version_matrix as a text table.
 
-                        diff_result = apt.apt_pkg.version_compare(package_in_dic['Version'],version.version)
+    Unsatisfied versions are marked with '!', provided packages with the
+    provider in brackets and absent packages with '-'.
+    """
+    table = [['Package', 'Constraint'] + list(repositories)]
+    for row in rows:
+        line = [row['Name'], ('%s %s' % (row['Relation'], row['Version'])).strip()]
+        for repository in repositories:
+            cell = row['Repositories'][repository]
+            if cell['Status'] == 'absent':
+                line.append('-')
+            elif cell['Status'] == 'unsatisfied':
+                line.append(cell['Version'] + ' !')
+            elif cell['Status'] == 'provided':
+                line.append('%s [%s]' % (cell['Version'], cell['Provider']))
+            else:
+                line.append(cell['Version'])
+        table.append(line)
+
+    widths = [max(len(line[column]) for line in table) for column in range(len(table[0]))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+                     for line in table)
+
+def get_closure_key(packages, args):
+    """Result cache key of the closure main resolves for args, or None
+    when a repository has no fingerprint."""
+    fingerprints = [packages.get_fingerprint(distr, indexes=args.indexes) for distr in [args.distr, 'mos']]
+    if not all(fingerprints):
+        return None
+    return ['closure', result_format, args.package_name, args.package_version or '', args.depth,
+            bool(args.all_alternatives), bool(args.cycles), args.distr, fingerprints]
+
+def write_closure(result, args):
+    """Print a closure result dict in the args.output format."""
+    if args.output == 'ndjson':
+        for record_type, name in [('resolved', 'Dependencies'), ('verified', 'Verified'),
+                                  ('unsatisfied', 'NotSatisfied')]:
+            for record in result[name]:
+                write_ndjson(record_type, record)
+        write_ndjson('summary', {'Name': args.package_name, 'Version': args.package_version or '',
+                                 'Resolved': len(result['Dependencies']),
+                                 'Verified': len(result['Verified']),
+                                 'Cycles': result['Cycles'], 'Levels': result['Levels']})
+    elif args.output == 'json':
+        output = dict(result)
+        output.update({'Name': args.package_name, 'Version': args.package_version or ''})
+        print json.dumps(output, sort_keys=True)
+    else:
+        print result['Dependencies']
+        print result['Verified']
+        print result['NotSatisfied']
 
-                        if diff_result == 1:
-                                self.not_satisfied_pkg_dictionary.append({'Name' : package_in_dic['Name'], 'Relation' : package_in_dic['Relation'], 'Version' : package_in_dic['Version'], 'PKG_WHICH_REQUIRES': package_in_dic['PKG_WHICH_REQUIRES'], 'NA': 'False'})
+        if args.cycles:
+            for cycle in result['Cycles']:
+                print 'Cycle: ' + ' -> '.join(cycle)
 
-            if not package_found:
-                package_in_dic = [d for d in self.pkg_dictionary if d['Name'] == package_name]
-                package_in_dic = package_in_dic.pop()
-                self.not_satisfied_pkg_dictionary.append({'Name' : package_in_dic['Name'], 'Relation' : package_in_dic['Relation'], 'Version' : package_in_dic['Version'], 'PKG_WHICH_REQUIRES': package_in_dic['PKG_WHICH_REQUIRES'], 'NA': 'True'})
+        if args.stats:
+            for stats in result['Levels']:
+                print ('Level %(Level)d: %(Expanded)d expanded, %(Edges)d edges, %(Time).3fs' % stats)
 
 def get_pkg_uri(uri):
     if uri:
@@ -359,37 +1111,125 @@ def get_pkg_uri(uri):
         return pkg_uri 
 
 def main(args):
+    instrument.configure(args.profile, args.profile_dump)
     packages = TrustyPackages()
-    repo_cache = ''
-    mos_repo_cache = ''
-
-
-    if args.update_cache:
-        repo_cache = packages.prepare_apt(args.distr, args.update_cache)
-    else:
-        repo_cache = packages.prepare_apt(args.distr)
-
-    if args.update_cache:
-        mos_repo_cache = packages.prepare_apt('mos', args.update_cache)
-    else:
-        mos_repo_cache = packages.prepare_apt('mos')
 
-    if args.package_name:
-        if args.package_version:
-            packages.get_package_from_cache(repo_cache, args.package_name, args.package_version)
+    result_cache = None
+    if args.result_cache and args.package_name and not (args.batch or args.rdepends or args.matrix):
+        result_cache = resultcache.ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024)
+        if not (args.update_cache or args.refresh or args.compile_index):
+            # A stored closure of unchanged repositories needs no cache
+            # to be opened at all.
+            with instrument.phase('result cache lookup'):
+                key = get_closure_key(packages, args)
+                result = result_cache.get(key) if key else None
+            if result is not None:
+                instrument.count('result cache hits')
+                with instrument.phase('output'):
+                    write_closure(result, args)
+                instrument.report()
+                return
+            instrument.count('result cache misses')
+
+    distrs = []
+    for distr in [args.distr, 'mos'] + (args.extra_distr or []) + (args.matrix or []):
+        if distr not in distrs:
+            distrs.append(distr)
+
+    with instrument.phase('prepare caches'):
+        caches = packages.prepare_caches(distrs, args.jobs, args.update_cache,
+                                         use_index=not args.no_index,
+                                         compile_index=args.compile_index,
+                                         refresh=args.refresh,
+                                         indexes=args.indexes)
+    repo_cache = caches[args.distr]
+    mos_repo_cache = caches['mos']
+
+    if args.batch:
+        with instrument.phase('batch'):
+            for record in resolve_batch(args.batch, repo_cache, mos_repo_cache, args.depth, args.jobs,
+                                        args.all_alternatives):
+                print json.dumps(record, sort_keys=True)
+                sys.stdout.flush()
+
+    elif args.rdepends:
+        with instrument.phase('reverse dependencies'):
+            records = packages.get_reverse_dependencies(repo_cache, args.rdepends, args.package_version)
+        if args.output == 'ndjson':
+            for record in records:
+                write_ndjson('rdepends', record)
+        elif args.output == 'json':
+            print json.dumps({'Name': args.rdepends, 'Version': args.package_version or '',
+                              'ReverseDependencies': records}, sort_keys=True)
         else:
-            packages.get_package_from_cache(repo_cache, args.package_name)
-
-        for package_in_dictionary in packages.pkg_dictionary:
-            packages.get_package_from_cache(repo_cache, package_in_dictionary['Name'], secondary_cache=mos_repo_cache)
-
-        print packages.pkg_dictionary
-        print packages.verified_pkg_dictionary
-        print packages.not_satisfied_pkg_dictionary
-
-
-    if repo_cache:
-        repo_cache.close()
+            print records
+
+    elif args.matrix:
+        if not args.package_name:
+            print >> sys.stderr, '--matrix needs a package name (-p).'
+            sys.exit(2)
+
+        # The closure is resolved once, in the primary cache; every other
+        # repository is only looked up.
+        packages.all_alternatives = args.all_alternatives
+        packages.quiet = True
+        with instrument.phase('closure'):
+            packages.resolve_closure(repo_cache, args.package_name, args.package_version, max_depth=args.depth)
+        with instrument.phase('matrix'):
+            rows = packages.get_version_matrix(caches, args.matrix, args.package_name, args.package_version)
+
+        if args.output == 'ndjson':
+            for row in rows:
+                write_ndjson('matrix', row)
+        elif args.output == 'json':
+            print json.dumps({'Name': args.package_name, 'Version': args.package_version or '',
+                              'Repositories': args.matrix, 'Matrix': rows}, sort_keys=True)
+        else:
+            print format_matrix(args.matrix, rows)
+
+    elif args.package_name:
+        packages.all_alternatives = args.all_alternatives
+        if args.output != 'repr':
+            packages.quiet = True
+        if args.output == 'ndjson':
+            # Records are written as they are found; only the closure
+            # itself is kept in memory.
+            packages.record_sink = write_ndjson
+            packages.keep_records = result_cache is not None
+
+        with instrument.phase('closure'):
+            packages.resolve_closure(repo_cache, args.package_name, args.package_version,
+                                     secondary_cache=mos_repo_cache, max_depth=args.depth,
+                                     report_cycles=args.cycles)
+
+        if result_cache is not None or args.output != 'ndjson':
+            result = {'Dependencies': records_as_dicts(packages.pkg_dictionary),
+                      'Verified': records_as_dicts(packages.verified_pkg_dictionary),
+                      'NotSatisfied': records_as_dicts(packages.not_satisfied_pkg_dictionary),
+                      'Cycles': packages.cycles, 'Levels': packages.level_stats}
+        if result_cache is not None:
+            with instrument.phase('result cache store'):
+                key = get_closure_key(packages, args)
+                if key:
+                    result_cache.set(key, result)
+
+        with instrument.phase('output'):
+            if args.output == 'ndjson':
+                # The records themselves were written as they were found.
+                write_ndjson('summary', {'Name': args.package_name, 'Version': args.package_version or '',
+                                         'Resolved': len(packages.pkg_dictionary),
+                                         'Verified': len(packages.verified_names),
+                                         'Cycles': packages.cycles, 'Levels': packages.level_stats})
+            else:
+                write_closure(result, args)
+
+    if args.debug:
+        print >> sys.stderr, debversion.comparator.format_stats()
+
+    for cache in caches.values():
+        cache.close()
+
+    instrument.report()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Get deploy tasks by role.')
@@ -397,10 +1237,48 @@ if __name__ == '__main__':
                         help="Package name.")
     parser.add_argument('-v', '--package_version', metavar=('PACKAGEVERSION'), type=str,\
                         help="Package version.")
+    parser.add_argument('-R', '--rdepends', metavar=('PACKAGENAME'), type=str,
+                        help='List the packages depending on PACKAGENAME; with -v, '
+                             'check their constraints against that version.')
+    parser.add_argument('-b', '--batch', metavar=('BATCHFILE'), type=str,
+                        help="File with 'name [version]' lines to resolve, '-' for stdin.")
     parser.add_argument('-u', '--update-cache', action='store_true',
                         help='Force cache update')
+    parser.add_argument('-r', '--refresh', action='store_true',
+                        help='Update only the sources whose Release file changed')
+    parser.add_argument('-c', '--compile-index', action='store_true',
+                        help='Compile package index snapshots of the caches')
+    parser.add_argument('-I', '--indexes', metavar=('DIR'), type=str,
+                        help='Read Packages/Sources files from DIR/DISTR (or DIR) instead of python-apt')
+    parser.add_argument('-n', '--no-index', action='store_true',
+                        help='Ignore package index snapshots and use python-apt')
+    parser.add_argument('-K', '--result-cache', metavar=('DIR'), type=str,
+                        help='Reuse closures stored in DIR while the repositories are unchanged')
+    parser.add_argument('--result-cache-size', metavar=('MB'), type=int, default=64,
+                        help='Size limit of the result cache in megabytes')
     parser.add_argument('-m', '--distr', metavar=('DISTR'), type=str,\
                         help='Update distribution', default='debian')
+    parser.add_argument('-A', '--all-alternatives', action='store_true',
+                        help='Expand every or-group alternative and ignore Provides')
+    parser.add_argument('-x', '--extra-distr', nargs='+', metavar=('DISTR'), type=str,
+                        help='Additional distributions to prepare')
+    parser.add_argument('-M', '--matrix', nargs='+', metavar=('DISTR'), type=str,
+                        help='Compare the closure of PACKAGENAME across the DISTR repositories')
+    parser.add_argument('-j', '--jobs', metavar=('JOBS'), type=int,
+                        help='Number of worker processes preparing the repositories (and parsing '
+                             'index files); with -n they only update them')
+    parser.add_argument('-D', '--depth', metavar=('DEPTH'), type=int,
+                        help='Stop expanding dependencies after DEPTH levels')
+    parser.add_argument('-C', '--cycles', action='store_true',
+                        help='Report dependency cycles')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='Print per-level resolution statistics')
+    parser.add_argument('-o', '--output', choices=['repr', 'json', 'ndjson'], default='repr',
+                        help='Output format; ndjson streams records as they are found')
+    parser.add_argument('-P', '--profile', choices=instrument.output_formats,
+                        help='Print phase timings and counters to stderr (or set PKGTOOLS_PROFILE)')
+    parser.add_argument('--profile-dump', metavar=('FILE'), type=str,
+                        help='Write cProfile stats to FILE (or set PKGTOOLS_PROFILE_DUMP)')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Verbosity level')
     parser.add_argument('-i', '--info', action='version',
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""On-disk cache of JSON results with least recently used eviction.
+
+Each entry is one JSON file named after the hash of its key; reading an
+entry touches the file, so file modification times order the entries by
+use. When the files grow past max_size bytes the least recently used
+ones are removed. Entries are written to a temporary file and renamed,
+so concurrent runs never read partial entries.
+
+Keys should include fingerprint() of the repositories a result was
+computed from, so that results go stale with the repositories.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import debindex
+
+default_max_size = 64 * 1024 * 1024
+entry_suffix = '.json'
+release_names = ['InRelease', 'Release']
+
+
+def fingerprint(directory):
+    """Return a hash of the repository indexes under directory.
+
+    It covers the contents of the Release files when there are any (they
+    list the hashes of every index), and otherwise the names, sizes and
+    modification times of the Packages/Sources files. Returns '' when
+    directory holds neither.
+    """
+    digest = hashlib.sha256()
+    release_files = []
+    for root, dirs, files in os.walk(directory):
+        release_files.extend(os.path.join(root, name) for name in files
+                             if any(name.endswith(release) for release in release_names))
+
+    if release_files:
+        for path in sorted(release_files):
+            digest.update(os.path.relpath(path, directory).encode('utf-8'))
+            with open(path, 'rb') as release:
+                digest.update(release.read())
+        return digest.hexdigest()
+
+    index_files = debindex.find_index_files(directory)
+    if not index_files:
+        return ''
+    for path in index_files:
+        stat = os.stat(path)
+        digest.update(('%s %d %d\n' % (os.path.relpath(path, directory), stat.st_size, stat.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+
+    """JSON results stored one file per key, evicted least recently used first"""
+
+    def __init__(self, directory, max_size=default_max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(encode_key(key)).hexdigest() + entry_suffix)
+
+    def get(self, key):
+        """Return the value stored for key, or None."""
+        path = self.get_path(key)
+        try:
+            with open(path, 'r') as entry_file:
+                entry = json.load(entry_file)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if encode_key(entry.get('Key')) != encode_key(key):
+            return None
+        return to_native(entry.get('Value'))
+
+    def set(self, key, value):
+        """Store value for key and evict entries over the size limit."""
+        handle, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'w') as entry_file:
+                json.dump({'Key': key, 'Value': value}, entry_file, sort_keys=True)
+            os.rename(temporary_path, self.get_path(key))
+        except (IOError, OSError):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until they fit max_size."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(entry_suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def to_native(value):
+    """Turn the unicode strings json returns on Python 2 back into str."""
+    if isinstance(value, dict):
+        return dict((to_native(key), to_native(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [to_native(item) for item in value]
+    if not isinstance(value, str) and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def encode_key(key):
+    """Serialize key the same way whether it holds tuples or lists."""
+    return json.dumps(key, sort_keys=True).encode('utf-8')
@@ -0,0 +1,67 @@
+"""Closures resolved over index files and over their compiled snapshot."""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+import debindex
+import pkgindex
+import pkgver
+
+
+def load_repository(directory, count, seed):
+    """Generate a synthetic repository; return its Deb822Cache and snapshot."""
+    os.makedirs(directory)
+    benchmark.generate_packages(directory, count, random.Random(seed))
+    cache = debindex.load_cache(directory, 1)
+    snapshot_path = os.path.join(directory, 'pkgindex.bin')
+    pkgindex.compile_index(cache, snapshot_path)
+    return cache, pkgindex.PackageIndex(snapshot_path)
+
+
+def resolve(cache, secondary_cache, root, all_alternatives=False):
+    packages = pkgver.TrustyPackages(quiet=True, all_alternatives=all_alternatives)
+    packages.resolve_closure(cache, root, secondary_cache=secondary_cache)
+    return (pkgver.records_as_dicts(packages.pkg_dictionary),
+            pkgver.records_as_dicts(packages.verified_pkg_dictionary),
+            pkgver.records_as_dicts(packages.not_satisfied_pkg_dictionary))
+
+
+class ClosureBackendTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pkgver.args = argparse.Namespace(debug=False)
+        cls.directory = tempfile.mkdtemp(prefix='pkg-tools-test-')
+        cls.cache, cls.snapshot = load_repository(os.path.join(cls.directory, 'debian'), 300, 1)
+        cls.secondary_cache, cls.secondary_snapshot = load_repository(os.path.join(cls.directory, 'mos'), 150, 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.snapshot.close()
+        cls.secondary_snapshot.close()
+        shutil.rmtree(cls.directory)
+
+    def test_expand_package(self):
+        for package in self.cache:
+            self.assertEqual(pkgver.TrustyPackages(quiet=True).expand_package(self.cache, package.name),
+                             pkgver.TrustyPackages(quiet=True).expand_package(self.snapshot, package.name),
+                             package.name)
+
+    def test_resolve_closure(self):
+        for package in sorted(self.cache.keys())[::10]:
+            self.assertEqual(resolve(self.cache, self.secondary_cache, package),
+                             resolve(self.snapshot, self.secondary_snapshot, package), package)
+
+    def test_resolve_closure_all_alternatives(self):
+        for package in sorted(self.cache.keys())[::30]:
+            self.assertEqual(resolve(self.cache, self.secondary_cache, package, True),
+                             resolve(self.snapshot, self.secondary_snapshot, package, True), package)
+
+
+if __name__ == '__main__':
+    unittest.main()
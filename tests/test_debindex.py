@@ -0,0 +1,61 @@
+"""deb822 stanza and relation field parsing of the pure Python backend."""
+
+import unittest
+
+import debindex
+
+
+class IterStanzasTest(unittest.TestCase):
+
+    def test_stanzas(self):
+        lines = ['Package: foo\n', 'Version: 1.0\n', '\n', '\n',
+                 'Package: bar\r\n', 'Version: 2.0\r\n']
+        self.assertEqual(list(debindex.iter_stanzas(lines)),
+                         [{'Package': 'foo', 'Version': '1.0'}, {'Package': 'bar', 'Version': '2.0'}])
+
+    def test_continuation_lines(self):
+        lines = ['Package: foo\n', 'Depends: libc6,\n', ' libbar1 (>= 2.0),\n', '\tlibbaz1\n',
+                 'Version: 1.0\n']
+        self.assertEqual(list(debindex.iter_stanzas(lines)),
+                         [{'Package': 'foo', 'Depends': 'libc6,\nlibbar1 (>= 2.0),\nlibbaz1', 'Version': '1.0'}])
+
+    def test_skipped_fields(self):
+        lines = ['Package: foo\n', 'Description: a package\n', ' with a long description\n',
+                 'Version: 1.0\n', '# a comment\n', 'Depends: libc6\n', ' | libc7\n']
+        self.assertEqual(list(debindex.iter_stanzas(lines, frozenset(['Package', 'Version', 'Depends']))),
+                         [{'Package': 'foo', 'Version': '1.0', 'Depends': 'libc6\n| libc7'}])
+
+    def test_no_stanzas(self):
+        self.assertEqual(list(debindex.iter_stanzas(['\n', '  \n'])), [])
+
+
+class ParseRelationsTest(unittest.TestCase):
+
+    def test_groups(self):
+        self.assertEqual(debindex.parse_relations('libc6 (>= 2.14), foo | bar (= 1.0-1),\n baz'),
+                         [[('libc6', '>=', '2.14')], [('foo', '', ''), ('bar', '=', '1.0-1')], [('baz', '', '')]])
+
+    def test_python_apt_relations(self):
+        self.assertEqual(debindex.parse_relations('a (<< 1), b (>> 1), c (<= 1), d (>= 1)'),
+                         [[('a', '<', '1')], [('b', '>', '1')], [('c', '<=', '1')], [('d', '>=', '1')]])
+
+    def test_deprecated_relations(self):
+        # '<' and '>' in control files are the obsolete spellings of '<=' and '>='.
+        self.assertEqual(debindex.parse_relations('a (< 1.0), b (> 1:2.0~rc1)'),
+                         [[('a', '<=', '1.0')], [('b', '>=', '1:2.0~rc1')]])
+
+    def test_arch_qualifiers(self):
+        self.assertEqual(debindex.parse_relations('python3:any (>= 3.5), libfoo1:amd64, perl:native'),
+                         [[('python3', '>=', '3.5')], [('libfoo1', '', '')], [('perl', '', '')]])
+
+    def test_spacing(self):
+        self.assertEqual(debindex.parse_relations('foo(>=1.0)|bar  (  <<  2  )'),
+                         [[('foo', '>=', '1.0'), ('bar', '<', '2')]])
+
+    def test_empty(self):
+        self.assertEqual(debindex.parse_relations(''), [])
+        self.assertEqual(debindex.parse_relations(' , '), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
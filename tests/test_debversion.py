@@ -0,0 +1,137 @@
+"""Pure Python Debian version comparison and the bisect sort keys."""
+
+import functools
+import random
+import unittest
+
+import debversion
+
+# (left, right, sign of the comparison) as apt orders them.
+orderings = [
+    ('1.0', '1.0', 0),
+    ('2.0', '10.0', -1),
+    ('1.01', '1.1', 0),
+    ('1.2.3', '1.2.3.0', -1),
+    # '~' sorts before everything, even the end of the version.
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~~', '1.0~', -1),
+    ('1.0~', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('0.9~rc1-1', '0.9', -1),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    # Epochs win over everything else; a zero epoch is no epoch.
+    ('1:0.1', '2.0', 1),
+    ('2:1.0', '1:9.9', 1),
+    ('0:1.0', '1.0', 0),
+    ('00:1.0', '1.0', 0),
+    # A missing revision compares like "-0".
+    ('1.0', '1.0-0', 0),
+    ('1.0-1', '1.0', 1),
+    ('1.0-1', '1.0-1ubuntu1', -1),
+    ('1.0-1', '1.0-1.1', -1),
+    ('1.0-2', '1.0-10', -1),
+    # Letters sort before non-letters, and both after the end.
+    ('1.0a', '1.0', 1),
+    ('1.0a', '1.0+', -1),
+    ('1.0a', '1.0.', -1),
+    ('1.0+dfsg', '1.0', 1),
+    ('1.0+b1', '1.0.1', -1),
+    ('a', 'B', 1),
+    ('7.6p2-4', '7.6-0', 1),
+    ('1.0.4-2', '1.0pre7-2', 1),
+    ('2.6.32-5', '2.6.32-41', -1),
+    ('1.18.4-1ubuntu1', '1.18.4-1ubuntu1.1', -1),
+]
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+def random_version(generator):
+    """A version mixing epochs, tildes, letters and revisions."""
+    parts = [str(generator.randint(0, 3)) for _ in range(generator.randint(1, 3))]
+    upstream = '.'.join(parts) + generator.choice(['', '~rc1', '~', 'a', '+dfsg', '.0', 'p1'])
+    epoch = generator.choice(['', '', '1:', '0:'])
+    revision = generator.choice(['', '-1', '-0', '-1ubuntu1', '-2~bpo1'])
+    return epoch + upstream + revision
+
+
+class CompareVersionsTest(unittest.TestCase):
+
+    def test_known_orderings(self):
+        for left, right, expected in orderings:
+            self.assertEqual(sign(debversion.compare_versions(left, right)), expected, (left, right))
+            self.assertEqual(sign(debversion.compare_versions(right, left)), -expected, (right, left))
+
+    def test_keys_follow_known_orderings(self):
+        for left, right, expected in orderings:
+            left_key, right_key = debversion.version_key(left), debversion.version_key(right)
+            self.assertEqual((left_key > right_key) - (left_key < right_key), expected, (left, right))
+
+    def test_sorted_by_key_agrees_with_compare(self):
+        generator = random.Random(7)
+        versions = [random_version(generator) for _ in range(500)] + \
+            [version for ordering in orderings for version in ordering[:2]]
+        by_key = sorted(versions, key=debversion.version_key)
+        by_compare = sorted(versions, key=functools.cmp_to_key(debversion.compare_versions))
+        self.assertEqual([debversion.version_key(version) for version in by_key],
+                         [debversion.version_key(version) for version in by_compare])
+        for left, right in zip(by_key, by_key[1:]):
+            self.assertTrue(debversion.compare_versions(left, right) <= 0, (left, right))
+
+    def test_split_version(self):
+        self.assertEqual(debversion.split_version('1:2.0-1-2'), ('1', '2.0-1', '2'))
+        self.assertEqual(debversion.split_version('2.0'), ('', '2.0', '0'))
+        self.assertEqual(debversion.split_version('0:2.0-3'), ('', '2.0', '3'))
+
+
+class SatisfyingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.versions = debversion.VersionList(['1.1', '1:0.1', '1.0~rc1', '1.0', '0.9', '1.0-0'])
+
+    def check(self, relation, version, expected):
+        self.assertEqual(self.versions.satisfying(relation, version), expected, relation)
+
+    def test_order(self):
+        self.assertEqual(self.versions.versions, ['0.9', '1.0~rc1', '1.0', '1.0-0', '1.1', '1:0.1'])
+        self.assertEqual(self.versions.newest(), '1:0.1')
+
+    def test_greater(self):
+        self.check('>=', '1.0', ['1.0', '1.0-0', '1.1', '1:0.1'])
+        # python-apt's '>' is strict, like '>>'.
+        self.check('>', '1.0', ['1.1', '1:0.1'])
+        self.check('>>', '1.0', ['1.1', '1:0.1'])
+
+    def test_lower(self):
+        self.check('<=', '1.0', ['0.9', '1.0~rc1', '1.0', '1.0-0'])
+        # python-apt's '<' is strict, like '<<'.
+        self.check('<', '1.0', ['0.9', '1.0~rc1'])
+        self.check('<<', '1.0', ['0.9', '1.0~rc1'])
+
+    def test_equal(self):
+        self.check('=', '1.0', ['1.0', '1.0-0'])
+        self.check('==', '1.0-0', ['1.0', '1.0-0'])
+        self.check('=', '1.0~rc2', [])
+        self.check('!=', '1.0', ['0.9', '1.0~rc1', '1.1', '1:0.1'])
+
+    def test_no_relation(self):
+        self.check('', '', self.versions.versions)
+
+    def test_unknown_relation(self):
+        self.assertRaises(ValueError, self.versions.satisfying, '~=', '1.0')
+
+    def test_satisfies(self):
+        self.assertTrue(debversion.satisfies('1.0~rc1', '<<', '1.0'))
+        self.assertFalse(debversion.satisfies('1.0', '<<', '1.0'))
+        self.assertTrue(debversion.satisfies('1:0.1', '>=', '9.9'))
+        self.assertTrue(debversion.satisfies('1.0', '=', '0:1.0-0'))
+
+    def test_objects_with_key(self):
+        versions = debversion.VersionList([('b', '2.0'), ('a', '10.0')], key=lambda item: item[1])
+        self.assertEqual(versions.satisfying('>>', '2.0'), [('a', '10.0')])
+
+
+if __name__ == '__main__':
+    unittest.main()
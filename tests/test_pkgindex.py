@@ -0,0 +1,177 @@
+"""Snapshots compiled by pkgindex read back through PackageIndex."""
+
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+import benchmark
+import debindex
+import pkgindex
+
+sid_packages = """Package: libfoo1
+Version: 1.2-1
+Architecture: amd64
+Source: foo
+Depends: libc6 (>= 2.14), zlib1g | libz
+Provides: libfoo (= 1.2), libfoo-abi-1
+Filename: pool/main/f/foo/libfoo1_1.2-1_amd64.deb
+
+Package: foo-utils
+Version: 1.2-1
+Architecture: amd64
+Source: foo (1.2-1)
+Pre-Depends: dpkg (>= 1.15)
+Depends: libfoo1 (= 1.2-1), mail-transport-agent
+Filename: pool/main/f/foo/foo-utils_1.2-1_amd64.deb
+
+Package: libc6
+Version: 2.31-1
+Architecture: amd64
+Filename: pool/main/g/glibc/libc6_2.31-1_amd64.deb
+
+Package: postfix
+Version: 3.5.6-1
+Architecture: amd64
+Provides: mail-transport-agent
+Filename: pool/main/p/postfix/postfix_3.5.6-1_amd64.deb
+
+Package: exim4
+Version: 4.94-1
+Architecture: amd64
+Provides: mail-transport-agent
+Filename: pool/main/e/exim4/exim4_4.94-1_amd64.deb
+"""
+
+experimental_packages = """Package: libfoo1
+Version: 1.2-1
+Architecture: amd64
+Source: foo
+Depends: libc6 (>= 2.14), zlib1g | libz
+Provides: libfoo (= 1.2), libfoo-abi-1
+Filename: pool/main/f/foo/libfoo1_1.2-1_amd64.deb
+
+Package: libfoo1
+Version: 1.3~rc1-1
+Architecture: amd64
+Source: foo
+Depends: libc6 (>= 2.17)
+Provides: libfoo (= 1.3~rc1), libfoo-abi-1
+Filename: pool/main/f/foo/libfoo1_1.3~rc1-1_amd64.deb
+"""
+
+
+def write(path, content):
+    with open(path, 'w') as index_file:
+        index_file.write(content)
+
+
+def origin_fields(origin):
+    return (origin.component, origin.archive, origin.site, origin.origin, origin.uri)
+
+
+def version_fields(version):
+    return (version.version, version.source_name, version.architecture,
+            [origin_fields(origin) for origin in version.origins],
+            [[(dependency.name, dependency.relation, dependency.version) for dependency in group]
+             for group in version.dependencies],
+            [tuple(provide[:2]) for provide in version.provides_list])
+
+
+class PackageIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='pkg-tools-test-')
+        lists = os.path.join(cls.directory, 'lists')
+        os.makedirs(lists)
+        write(os.path.join(lists, 'ftp.example.org_debian_dists_sid_main_binary-amd64_Packages'), sid_packages)
+        write(os.path.join(lists, 'ftp.example.org_debian_dists_sid_InRelease'), 'Origin: Debian\nSuite: unstable\n')
+        write(os.path.join(lists, 'ftp.example.org_debian_dists_experimental_main_binary-amd64_Packages'),
+              experimental_packages)
+        benchmark.generate_packages(lists, 300, random.Random(3))
+        cls.cache = debindex.load_cache(lists, 1)
+        cls.path = os.path.join(cls.directory, 'pkgindex.bin')
+        pkgindex.compile_index(cls.cache, cls.path)
+        cls.index = pkgindex.PackageIndex(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.close()
+        shutil.rmtree(cls.directory)
+
+    def test_packages(self):
+        self.assertEqual(len(self.index), len(self.cache))
+        self.assertEqual(self.index.keys(), sorted(self.cache.keys()))
+        self.assertEqual([package.name for package in self.index], sorted(self.cache.keys()))
+        for package in self.cache:
+            self.assertIn(package.name, self.index)
+            self.assertEqual([version_fields(version) for version in self.index[package.name].versions],
+                             [version_fields(version) for version in package.versions], package.name)
+
+    def test_lookup_misses(self):
+        for name in ['', 'a', 'exim3', 'libfoo', 'mail-transport-agent', 'pkg00300', 'zzz']:
+            self.assertNotIn(name, self.index)
+            self.assertRaises(KeyError, lambda: self.index[name])
+
+    def test_merged_origins(self):
+        versions = self.index['libfoo1'].versions
+        self.assertEqual([version.version for version in versions], ['1.3~rc1-1', '1.2-1'])
+        # In the order the lists were read.
+        self.assertEqual([origin_fields(origin) for origin in versions[1].origins],
+                         [('main', 'experimental', 'ftp.example.org', '', 'http://ftp.example.org/debian'),
+                          ('main', 'sid', 'ftp.example.org', 'Debian', 'http://ftp.example.org/debian')])
+        self.assertEqual(pkgindex.get_archive_uri(versions[1]), 'http://ftp.example.org/debian')
+
+    def test_dependencies(self):
+        version = self.index['foo-utils'].versions[0]
+        self.assertEqual(version.source_name, 'foo')
+        self.assertEqual([[(dependency.name, dependency.relation, dependency.version) for dependency in group]
+                          for group in version.dependencies],
+                         [[('dpkg', '>=', '1.15')], [('libfoo1', '=', '1.2-1')], [('mail-transport-agent', '', '')]])
+
+    def test_providers(self):
+        reference = pkgindex.DependencyIndex(self.cache)
+        names = set(reference.provided) | set(self.cache.keys())
+        for name in names:
+            self.assertEqual(sorted(self.index.providers(name)), sorted(reference.providers(name)), name)
+        self.assertEqual(sorted(self.index.providers('libfoo')),
+                         [('libfoo1', '1.2-1', '1.2'), ('libfoo1', '1.3~rc1-1', '1.3~rc1')])
+        self.assertEqual(self.index.providers('nothing'), [])
+        self.assertTrue(self.index.is_virtual_package('mail-transport-agent'))
+        self.assertFalse(self.index.is_virtual_package('postfix'))
+        self.assertIs(pkgindex.get_dependency_index(self.index), self.index)
+
+    def test_reverse_dependencies(self):
+        reference = pkgindex.DependencyIndex(self.cache)
+        for name in reference.dependents:
+            self.assertEqual(sorted(self.index.reverse_dependencies(name)),
+                             sorted(reference.reverse_dependencies(name)), name)
+        self.assertEqual(sorted(self.index.reverse_dependencies('libc6')),
+                         [('libfoo1', '1.2-1', '>=', '2.14'), ('libfoo1', '1.3~rc1-1', '>=', '2.17')])
+
+    def copy(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as index_file:
+            index_file.write(content)
+        return path
+
+    def test_rejects_other_formats(self):
+        with open(self.path, 'rb') as index_file:
+            content = index_file.read()
+        older = content[:6] + struct.pack('<H', pkgindex.FORMAT - 1) + content[8:]
+        self.assertRaises(ValueError, pkgindex.PackageIndex, self.copy('older.bin', older))
+        self.assertRaises(ValueError, pkgindex.PackageIndex, self.copy('other.bin', b'PK\x03\x04' + content[4:]))
+
+    def test_rejects_truncated_files(self):
+        with open(self.path, 'rb') as index_file:
+            content = index_file.read()
+        for size in [0, 5, pkgindex.header_struct.size - 1, pkgindex.header_struct.size,
+                     len(content) // 2, len(content) - 1]:
+            self.assertRaises(ValueError, pkgindex.PackageIndex, self.copy('truncated.bin', content[:size]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+"""Release file checks of pkgver.py -r against a file:// mirror."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from cStringIO import StringIO
+
+import pkgver
+
+
+class Response(object):
+
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class RequestException(Exception):
+    pass
+
+
+class FakeModule(object):
+
+    """Puts a stub module into sys.modules for the time of a test"""
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.module = types.ModuleType(name)
+        self.module.__dict__.update(attributes)
+
+    def __enter__(self):
+        self.saved = sys.modules.get(self.name)
+        sys.modules[self.name] = self.module
+        return self.module
+
+    def __exit__(self, *exc_info):
+        if self.saved is None:
+            del sys.modules[self.name]
+        else:
+            sys.modules[self.name] = self.saved
+        return False
+
+
+class ReleaseCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pkg-tools-test-')
+        self.mirror = os.path.join(self.directory, 'mirror')
+        self.cache = os.path.join(self.directory, 'cache')
+        os.makedirs(os.path.join(self.mirror, 'dists', 'sid'))
+        os.makedirs(os.path.join(self.cache, 'etc', 'apt'))
+        self.write_release('Suite: sid\n', 1000)
+        self.lines = ['deb file://%s sid main\n' % self.mirror,
+                      'deb-src file://%s sid main\n' % self.mirror,
+                      'deb file://%s/missing sid main\n' % self.directory]
+        self.write_sources_list(self.lines)
+        self.key = 'file://%s sid' % self.mirror
+        self.packages = pkgver.TrustyPackages()
+        # check_sources reports every source on stderr.
+        self.stderr, sys.stderr = sys.stderr, StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.directory)
+
+    def write_release(self, content, mtime):
+        path = os.path.join(self.mirror, 'dists', 'sid', 'InRelease')
+        with open(path, 'w') as release:
+            release.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def write_sources_list(self, lines):
+        with open(os.path.join(self.cache, 'etc', 'apt', 'sources.list'), 'w') as sources_list:
+            sources_list.write(''.join(lines))
+
+    def check(self):
+        """Run check_sources and store its state the way prepare_apt does."""
+        changed_lines, release_state = self.packages.check_sources(self.cache, 'debian')
+        with open(os.path.join(self.cache, pkgver.release_state_file_name), 'w') as state_file:
+            json.dump(release_state, state_file, indent=2, sort_keys=True)
+        return changed_lines, release_state
+
+    def test_new_then_fresh(self):
+        changed_lines, release_state = self.check()
+        self.assertEqual(changed_lines, self.lines[:2])
+        self.assertEqual(sorted(release_state), [self.key])
+
+        changed_lines, second_state = self.check()
+        self.assertEqual(changed_lines, [])
+        self.assertEqual(second_state[self.key]['Changed'], release_state[self.key]['Changed'])
+        self.assertIn('sid: fresh', sys.stderr.getvalue())
+        self.assertIn('missing sid: unreachable', sys.stderr.getvalue())
+
+    def test_changed(self):
+        changed_lines, first_state = self.check()
+        self.write_release('Suite: sid\nDate: later\n', 2000)
+        changed_lines, release_state = self.check()
+        self.assertEqual(changed_lines, self.lines[:2])
+        self.assertNotEqual(release_state[self.key]['Hash'], first_state[self.key]['Hash'])
+
+    def test_touched_but_same_content(self):
+        self.check()
+        self.write_release('Suite: sid\n', 2000)
+        changed_lines, release_state = self.check()
+        self.assertEqual(changed_lines, [])
+        self.assertEqual(release_state[self.key]['Modified'], str(2000.0))
+
+    def test_new_source(self):
+        self.check()
+        os.makedirs(os.path.join(self.mirror, 'dists', 'experimental'))
+        with open(os.path.join(self.mirror, 'dists', 'experimental', 'Release'), 'w') as release:
+            release.write('Suite: experimental\n')
+        line = 'deb file://%s experimental main\n' % self.mirror
+        self.write_sources_list(self.lines + [line])
+        changed_lines, release_state = self.check()
+        self.assertEqual(changed_lines, [line])
+
+    def test_unreachable(self):
+        uri = 'file://%s/missing' % self.directory
+        self.assertEqual(self.packages.check_release(uri, 'sid', None), ('unreachable', None))
+        known = {'URL': uri + '/dists/sid/InRelease', 'Hash': 'x', 'Changed': 1.0}
+        self.assertEqual(self.packages.check_release(uri, 'sid', known), ('unreachable', known))
+
+    def test_state_file_round_trip(self):
+        changed_lines, release_state = self.check()
+        with open(os.path.join(self.cache, pkgver.release_state_file_name), 'r') as state_file:
+            self.assertEqual(json.load(state_file), json.loads(json.dumps(release_state)))
+        state = release_state[self.key]
+        self.assertEqual(state['URL'], 'file://%s/dists/sid/InRelease' % self.mirror)
+        self.assertEqual(sorted(state), ['Changed', 'Checked', 'Hash', 'Modified', 'URL'])
+
+    def test_not_modified(self):
+        requests = []
+
+        def get(url, headers=None, timeout=None):
+            requests.append((url, headers))
+            if headers.get('If-None-Match') == '"v1"':
+                return Response(304)
+            return Response(200, 'Suite: sid\n', {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+
+        with FakeModule('requests', get=get, RequestException=RequestException):
+            status, state = self.packages.check_release('http://mirror.example.org/debian', 'sid', None)
+            self.assertEqual(status, 'new')
+            self.assertEqual(state['ETag'], '"v1"')
+            self.assertEqual(requests[-1][1], {})
+
+            status, second_state = self.packages.check_release('http://mirror.example.org/debian', 'sid', state)
+            self.assertEqual(status, 'fresh')
+            self.assertEqual(requests[-1][1], {'If-None-Match': '"v1"',
+                                               'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+            self.assertEqual((second_state['Hash'], second_state['Changed']), (state['Hash'], state['Changed']))
+
+    def test_remote_falls_back_to_release(self):
+        def get(url, headers=None, timeout=None):
+            if url.endswith('InRelease'):
+                raise RequestException('connection refused')
+            return Response(200, 'Suite: sid\n')
+
+        with FakeModule('requests', get=get, RequestException=RequestException):
+            status, state = self.packages.check_release('http://mirror.example.org/debian', 'sid', None)
+        self.assertEqual(status, 'new')
+        self.assertEqual(state['URL'], 'http://mirror.example.org/debian/dists/sid/Release')
+
+    def test_refresh_cache_fetches_changed_lines_only(self):
+        settings = {}
+        fetched = []
+
+        class Config(object):
+            def set(self, name, value):
+                settings[name] = value
+
+        class Cache(object):
+            def update(self, sources_list=None):
+                with open(sources_list, 'r') as changed:
+                    fetched.append(changed.read())
+
+            def open(self):
+                fetched.append('opened')
+
+        with FakeModule('apt', apt_pkg=types.ModuleType('apt_pkg')) as apt:
+            apt.apt_pkg.config = Config()
+            self.packages.refresh_cache(Cache(), self.cache, self.lines[:1])
+
+        self.assertEqual(fetched, [self.lines[0], 'opened'])
+        self.assertEqual(settings, {'APT::Get::List-Cleanup': 'false', 'APT::List-Cleanup': 'false'})
+        self.assertFalse(os.path.exists(os.path.join(self.cache, 'etc', 'apt', 'sources.list.changed')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Pruned directory walker for large source trees.
+
+TreeWalker.walk() yields the files under a directory matching the
+include globs as soon as their directory is listed, in os.walk order,
+without building the list of the whole tree. Directories are pruned
+before they are read when they match an exclude glob, one of the
+default_excludes (VCS metadata, virtualenvs, tox, build output,
+node_modules, ...) or a .gitignore rule of the tree, and virtualenvs are
+recognized by their pyvenv.cfg. Directory symlinks are followed only on
+request, and then every directory is entered at most once, which breaks
+symlink loops.
+
+Globs without a '/' match the name of a file or directory, the others
+its path relative to the walked directory. Directories are listed with
+os.scandir (or the scandir backport) when available.
+"""
+
+import fnmatch
+import os
+import re
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+default_includes = ['*.py']
+default_excludes = ['.git', '.hg', '.svn', '.bzr', '.tox', '.nox', '.venv', 'venv', '.eggs', '*.egg-info',
+                    '__pycache__', '.mypy_cache', '.pytest_cache', 'node_modules', 'site-packages',
+                    'build', 'dist']
+gitignore_file_name = '.gitignore'
+virtualenv_marker = 'pyvenv.cfg'
+
+
+def list_directory(path):
+    """Return the (name, is_dir, is_symlink) entries of the directory path.
+
+    is_dir follows symlinks, like os.path.isdir.
+    """
+    if scandir is not None:
+        entries = []
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            entries.append((entry.name, is_dir, entry.is_symlink()))
+        return entries
+
+    entries = []
+    for name in os.listdir(path):
+        entry_path = os.path.join(path, name)
+        entries.append((name, os.path.isdir(entry_path), os.path.islink(entry_path)))
+    return entries
+
+
+def gitignore_regex(pattern):
+    """Translate a .gitignore glob into a regular expression."""
+    parts = []
+    position = 0
+    length = len(pattern)
+    while position < length:
+        if pattern.startswith('**/', position):
+            parts.append('(?:.*/)?')
+            position += 3
+            continue
+        if pattern.startswith('**', position):
+            parts.append('.*')
+            position += 2
+            continue
+
+        char = pattern[position]
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and pattern.find(']', position + 2) != -1:
+            end = pattern.find(']', position + 2)
+            chars = pattern[position + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[%s]' % chars.replace('\\', '\\\\'))
+            position = end
+        elif char == '\\' and position + 1 < length:
+            position += 1
+            parts.append(re.escape(pattern[position]))
+        else:
+            parts.append(re.escape(char))
+        position += 1
+
+    return re.compile(''.join(parts) + '$')
+
+
+class GitignoreRule(object):
+
+    """One pattern of a .gitignore file, scoped to the directory holding it"""
+    __slots__ = ('base', 'regex', 'negated', 'directory_only', 'anchored')
+
+    def __init__(self, base, pattern):
+        self.base = base
+        self.negated = pattern.startswith('!')
+        if self.negated:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        self.directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # Patterns with a slash before their end are relative to base;
+        # the others match names at any depth.
+        self.anchored = '/' in pattern
+        self.regex = gitignore_regex(pattern.lstrip('/'))
+
+    def matches(self, relative_path, is_dir):
+        if self.directory_only and not is_dir:
+            return False
+        if self.base:
+            if not relative_path.startswith(self.base + '/'):
+                return False
+            relative_path = relative_path[len(self.base) + 1:]
+        if self.anchored:
+            return self.regex.match(relative_path) is not None
+        return self.regex.match(relative_path.rsplit('/', 1)[-1]) is not None
+
+
+def read_gitignore(path, base):
+    """Return the GitignoreRules of the .gitignore file path found in base."""
+    rules = []
+    try:
+        with open(path, 'r') as gitignore:
+            lines = gitignore.read().splitlines()
+    except (IOError, OSError):
+        return rules
+
+    for line in lines:
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        if line and not line.startswith('#'):
+            rules.append(GitignoreRule(base, line))
+    return rules
+
+
+def is_ignored(rules, relative_path, is_dir):
+    """Apply rules in order; the last matching one decides, as in git."""
+    ignored = False
+    for rule in rules:
+        if rule.matches(relative_path, is_dir):
+            ignored = not rule.negated
+    return ignored
+
+
+def match_globs(globs, name, relative_path):
+    for glob in globs:
+        if fnmatch.fnmatchcase(relative_path if '/' in glob else name, glob):
+            return True
+
+    return False
+
+
+class TreeWalker(object):
+
+    """Streams the matching files of a tree, pruning excluded directories"""
+
+    def __init__(self, include=None, exclude=None, use_default_excludes=True, use_gitignore=True,
+                 follow_links=False):
+        self.include = include or default_includes
+        self.exclude = exclude or []
+        self.prune_globs = self.exclude + (default_excludes if use_default_excludes else [])
+        self.use_default_excludes = use_default_excludes
+        self.use_gitignore = use_gitignore
+        self.follow_links = follow_links
+        self.directories = 0
+        self.pruned = 0
+        self.loops = 0
+
+    def is_pruned(self, name, relative_path, rules=()):
+        return match_globs(self.prune_globs, name, relative_path) or \
+            (rules and is_ignored(rules, relative_path, True))
+
+    def is_included(self, name, relative_path, rules=()):
+        return match_globs(self.include, name, relative_path) and \
+            not match_globs(self.exclude, name, relative_path) and \
+            not (rules and is_ignored(rules, relative_path, False))
+
+    def accepts(self, relative_path):
+        """Tell whether walk() would yield relative_path, .gitignore aside."""
+        parts = relative_path.replace(os.sep, '/').split('/')
+        for end in range(1, len(parts)):
+            if self.is_pruned(parts[end - 1], '/'.join(parts[:end])):
+                return False
+        return self.is_included(parts[-1], '/'.join(parts))
+
+    def walk(self, directory):
+        """Yield the path of every matching file under directory."""
+        visited = set()
+        stack = [(directory, '', [])]
+        while stack:
+            path, relative_path, rules = stack.pop()
+            try:
+                stat = os.stat(path)
+                entries = list_directory(path)
+            except OSError:
+                continue
+
+            # A directory reached twice through symlinks is a loop, or a
+            # tree already walked.
+            key = (stat.st_dev, stat.st_ino)
+            if key in visited:
+                self.loops += 1
+                continue
+            visited.add(key)
+
+            names = set(entry[0] for entry in entries)
+            if relative_path and self.use_default_excludes and virtualenv_marker in names:
+                self.pruned += 1
+                continue
+            self.directories += 1
+            if self.use_gitignore and gitignore_file_name in names:
+                rules = rules + read_gitignore(os.path.join(path, gitignore_file_name), relative_path)
+
+            subdirectories = []
+            for name, is_dir, is_symlink in entries:
+                entry_relative_path = relative_path + '/' + name if relative_path else name
+                if is_dir:
+                    if is_symlink and not self.follow_links:
+                        continue
+                    if self.is_pruned(name, entry_relative_path, rules):
+                        self.pruned += 1
+                        continue
+                    subdirectories.append((os.path.join(path, name), entry_relative_path, rules))
+                elif self.is_included(name, entry_relative_path, rules):
+                    yield os.path.join(path, name)
+
+            stack.extend(reversed(subdirectories))